@@ -0,0 +1,126 @@
+"""
+Response caching for read endpoints.
+
+- response_cache: bounded in-process TTL/LRU cache of serialized responses,
+  explicitly invalidated by the write paths (approval, parse completion,
+  provider CRUD). It is per worker, so RESPONSE_CACHE_TTL bounds how stale
+  another worker's copy can get.
+- cached_json_response(): serves from that cache with ETag / Last-Modified
+  and answers If-None-Match / If-Modified-Since with 304 and no body.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Callable, Optional
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+response_cache = TTLCache(
+    maxsize=int(os.environ.get("RESPONSE_CACHE_SIZE", "1024")),
+    ttl=float(os.environ.get("RESPONSE_CACHE_TTL", "30")),
+)
+
+
+def extraction_cache_key(document_id: str) -> str:
+    return f"extraction:{document_id}"
+
+
+PROVIDERS_CACHE_KEY = "llm:providers"
+
+
+def _to_datetime(value) -> Optional[datetime]:
+    if not value:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).replace(microsecond=0)
+
+
+def _not_modified(request: Request, etag: str, last_modified: Optional[datetime]) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def cached_json_response(request: Request, key: str, loader: Callable[[], tuple]) -> Response:
+    """
+    loader() -> (payload, last_modified) is only called on a cache miss.
+    Exceptions from loader (e.g. a 404 HTTPException) propagate and are not cached.
+    """
+    entry = response_cache.get(key)
+    if entry is None:
+        payload, last_modified = loader()
+        body = json.dumps(jsonable_encoder(payload), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        entry = {
+            "body": body,
+            "etag": f'"{hashlib.sha1(body).hexdigest()}"',
+            "last_modified": _to_datetime(last_modified),
+        }
+        response_cache.set(key, entry)
+
+    headers = {
+        "ETag": entry["etag"],
+        # Always revalidate: invalidation on writes must be visible immediately
+        "Cache-Control": "private, no-cache",
+    }
+    if entry["last_modified"]:
+        headers["Last-Modified"] = format_datetime(entry["last_modified"], usegmt=True)
+
+    if _not_modified(request, entry["etag"], entry["last_modified"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry["body"], media_type="application/json", headers=headers)
@@ -1,16 +1,30 @@
 import os
-from supabase import create_client, Client
+import threading
+from typing import TYPE_CHECKING
 from dotenv import load_dotenv
 
-load_dotenv()
+if TYPE_CHECKING:
+    from supabase import Client
 
-url: str = os.environ.get("SUPABASE_URL")
-key: str = os.environ.get("SUPABASE_SERVICE_KEY") # Use Service Key for Backend to bypass RLS if needed, or Anon Key if acting as user
+# Built on first use (or by the app lifespan warmup), not at import time,
+# so workers, tests and scripts can import modules without credentials.
+_supabase = None
+_supabase_lock = threading.Lock()
 
-if not url or not key:
-    raise ValueError("Supabase credentials not found in environment variables.")
 
-supabase: Client = create_client(url, key)
+def get_supabase() -> "Client":
+    global _supabase
+    if _supabase is None:
+        with _supabase_lock:
+            if _supabase is None:
+                from supabase import create_client
 
-def get_supabase() -> Client:
-    return supabase
+                load_dotenv()
+                url: str = os.environ.get("SUPABASE_URL")
+                key: str = os.environ.get("SUPABASE_SERVICE_KEY") # Use Service Key for Backend to bypass RLS if needed, or Anon Key if acting as user
+
+                if not url or not key:
+                    raise ValueError("Supabase credentials not found in environment variables.")
+
+                _supabase = create_client(url, key)
+    return _supabase
@@ -1,14 +1,59 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks
+import time
+_import_started = time.perf_counter()
+
+from dotenv import load_dotenv
+# Before any other import: several modules read their settings from the environment at import time
+load_dotenv()
+
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, BackgroundTasks, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from database import get_supabase
+from cache import cached_json_response, extraction_cache_key
+from repository import get_repository, close_repository, ApprovalConflictError
 from services.storage import StorageService
-from services.parser import ParserService
+from services.parser import ParserService, LLM_FREE_METHODS
+from services.renditions import create_renditions
+from services.llm import get_llm_service, reset_llm_service
+from services.pdf_text import shutdown_pdf_pool
+from services.usage import close_usage_recorder
 from routers import llm_settings
 from pydantic import BaseModel
 from typing import Optional
-import uuid
 
-app = FastAPI(title="FinSight AI API")
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+
+def warmup():
+    """Build clients before the worker accepts traffic. Failures are logged, not fatal."""
+    for name, build in (
+        ("supabase", get_supabase),
+        ("repository", get_repository),
+        ("llm provider", get_llm_service),
+    ):
+        started = time.perf_counter()
+        try:
+            build()
+            print(f"[Startup] {name} ready ({(time.perf_counter() - started) * 1000:.0f} ms)")
+        except Exception as e:
+            print(f"[Startup] Warning: {name} not ready, will retry on first use: {e}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    await run_in_threadpool(warmup)
+    print(f"[Startup] Imports {IMPORT_SECONDS * 1000:.0f} ms, warmup {(time.perf_counter() - started) * 1000:.0f} ms")
+    yield
+    reset_llm_service()
+    close_usage_recorder()
+    close_repository()
+    shutdown_pdf_pool()
+    print("[Shutdown] Clients closed")
+
+
+app = FastAPI(title="FinSight AI API", lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -32,9 +77,8 @@ def health_check():
     return {"status": "ok", "service": "FinSight AI API"}
 
 @app.get("/db-check")
-def db_check():
+def db_check(supabase=Depends(get_supabase)):
     try:
-        supabase = get_supabase()
         response = supabase.table("companies").select("count", count="exact").execute()
         return {"status": "connected", "data": response.data}
     except Exception as e:
@@ -42,13 +86,13 @@ def db_check():
 
 @app.post("/documents/upload")
 async def upload_document(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
-    company_id: str = Form(...)
+    company_id: str = Form(...),
+    storage: StorageService = Depends(StorageService),
+    repo=Depends(get_repository)
 ):
     try:
-        storage = StorageService()
-        supabase = get_supabase()
-        
         # 1. Read file content
         file_content = await file.read()
         
@@ -69,18 +113,23 @@ async def upload_document(
             "status": "uploaded"
         }
         
-        response = supabase.table("documents").insert(doc_data).execute()
+        document = repo.create_document(doc_data)
         
-        return {"status": "success", "document": response.data[0]}
+        # 4. Thumbnail + preview for the review UI, off the request path
+        background_tasks.add_task(
+            create_renditions,
+            document["id"], storage_path, file_content, file.filename, file.content_type
+        )
+        
+        return {"status": "success", "document": document}
         
     except Exception as e:
         print(f"Upload error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/documents/{document_id}/parse")
-async def parse_document(document_id: str, background_tasks: BackgroundTasks):
+async def parse_document(document_id: str, background_tasks: BackgroundTasks, parser: ParserService = Depends(ParserService)):
     try:
-        parser = ParserService()
         # Run parsing in background
         background_tasks.add_task(parser.parse_document, document_id)
         return {"status": "processing", "message": "Document parsing started in background"}
@@ -89,16 +138,18 @@ async def parse_document(document_id: str, background_tasks: BackgroundTasks):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/documents/{document_id}/extraction")
-async def get_extraction_result(document_id: str):
-    """Get extraction results for user review"""
-    try:
-        supabase = get_supabase()
-        result = supabase.table("extraction_results").select("*").eq("document_id", document_id).eq("status", "pending_review").execute()
+async def get_extraction_result(document_id: str, request: Request, repo=Depends(get_repository)):
+    """Get extraction results for user review (cached, supports If-None-Match)"""
+    def load():
+        extraction = repo.get_pending_extraction(document_id)
         
-        if not result.data:
+        if not extraction:
             raise HTTPException(status_code=404, detail="No pending extraction found for this document")
         
-        return {"status": "success", "extraction": result.data[0]}
+        return {"status": "success", "extraction": extraction}, extraction.get("reviewed_at") or extraction.get("created_at")
+    
+    try:
+        return cached_json_response(request, extraction_cache_key(document_id), load)
     except HTTPException:
         raise
     except Exception as e:
@@ -106,16 +157,40 @@ async def get_extraction_result(document_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/extractions/approve")
-async def approve_extraction(request: ApprovalRequest):
+async def approve_extraction(request: ApprovalRequest, background_tasks: BackgroundTasks, parser: ParserService = Depends(ParserService)):
     """Approve extraction and save to final tables"""
     try:
-        parser = ParserService()
         result = parser.approve_extraction(request.extraction_id, request.user_corrections)
+        # Learn the layout from the approved values so similar documents skip the LLM
+        background_tasks.add_task(
+            parser.learn_template,
+            result["company_id"], result["document_id"], result["doc_type"], result["data"]
+        )
         return {"status": "success", "message": "Data approved and saved"}
+    except ApprovalConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
         print(f"Approval error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/metrics/extraction")
+async def extraction_metrics(repo=Depends(get_repository)):
+    """Share of documents extracted without an LLM call"""
+    try:
+        counts = repo.extraction_method_counts()
+        total = sum(counts.values())
+        without_llm = sum(c for method, c in counts.items() if method in LLM_FREE_METHODS)
+        return {
+            "status": "success",
+            "total": total,
+            "without_llm": without_llm,
+            "llm_free_ratio": round(without_llm / total, 4) if total else 0.0,
+            "by_method": counts
+        }
+    except Exception as e:
+        print(f"Metrics error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.get("/")
 def root():
     return {"message": "Welcome to FinSight AI API"}
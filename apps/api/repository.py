@@ -0,0 +1,555 @@
+"""
+Data-access layer for the document pipeline hot paths.
+
+Two backends are available, selected with the DB_BACKEND env variable:
+- "postgrest" (default): goes through the supabase-py client (one HTTP call per operation)
+- "postgres": pooled direct connection (DATABASE_URL) with prepared statements,
+  status transitions folded into single statements/CTEs. Named prepared statements
+  need a session-level connection (direct port 5432 or a session-mode pooler).
+"""
+import os
+import threading
+import weakref
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from database import get_supabase
+
+# Tables approved extractions may be written into
+FINAL_TABLES = {"invoices", "contracts", "bank_statements", "payroll_records"}
+
+# Values of extraction_results.extraction_method
+EXTRACTION_METHODS = ("llm", "template", "text_layer", "e_invoice")
+
+
+def is_connection_error(error: Exception) -> bool:
+    """True if the database was unreachable (worth retrying), as opposed to the statement being rejected."""
+    try:
+        import psycopg2
+
+        if isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            return True
+    except ImportError:
+        pass
+    try:
+        import httpx
+
+        if isinstance(error, httpx.TransportError):
+            return True
+    except ImportError:
+        pass
+    return isinstance(error, (ConnectionError, TimeoutError))
+
+
+class ApprovalConflictError(ValueError):
+    """The extraction is no longer pending review (already approved, or re-parsed)."""
+
+
+class PostgrestRepository:
+    """Repository backed by the supabase-py (PostgREST) client."""
+
+    backend = "postgrest"
+
+    def __init__(self):
+        self.supabase = get_supabase()
+
+    def create_document(self, doc_data: dict) -> dict:
+        response = self.supabase.table("documents").insert(doc_data).execute()
+        return response.data[0]
+
+    def claim_document(self, document_id: str) -> Optional[dict]:
+        """Fetch a document and mark it as 'processing'. Returns None if not found."""
+        doc_response = self.supabase.table("documents").select("*").eq("id", document_id).execute()
+        if not doc_response.data:
+            return None
+        self.supabase.table("documents").update({"status": "processing"}).eq("id", document_id).execute()
+        return doc_response.data[0]
+
+    def get_document(self, document_id: str) -> Optional[dict]:
+        result = self.supabase.table("documents").select("*").eq("id", document_id).execute()
+        return result.data[0] if result.data else None
+
+    def save_extraction(self, document_id: str, doc_type: str, data: dict, extraction_method: str = "llm", confidence_score: float = None, template_id: str = None) -> str:
+        """Store an extraction for review and mark the document as 'extracted'."""
+        result = self.supabase.table("extraction_results").insert({
+            "document_id": document_id,
+            "doc_type": doc_type,
+            "extracted_data": data,
+            "status": "pending_review",
+            "extraction_method": extraction_method,
+            "confidence_score": confidence_score,
+            "template_id": template_id
+        }).execute()
+        self.supabase.table("documents").update({
+            "status": "extracted",
+            "file_type": doc_type
+        }).eq("id", document_id).execute()
+        return result.data[0]["id"]
+
+    def set_document_renditions(self, document_id: str, thumbnail_path: Optional[str], preview_path: Optional[str]):
+        self.supabase.table("documents").update({
+            "thumbnail_path": thumbnail_path,
+            "preview_path": preview_path
+        }).eq("id", document_id).execute()
+
+    def mark_document_error(self, document_id: str, error_message: str):
+        self.supabase.table("documents").update({
+            "status": "error",
+            "error_message": error_message
+        }).eq("id", document_id).execute()
+
+    def get_pending_extraction(self, document_id: str) -> Optional[dict]:
+        result = self.supabase.table("extraction_results").select("*").eq("document_id", document_id).eq("status", "pending_review").execute()
+        return result.data[0] if result.data else None
+
+    def get_extraction_for_approval(self, extraction_id: str) -> Optional[dict]:
+        """Extraction row plus the owning document's company_id."""
+        result = self.supabase.table("extraction_results").select("*").eq("id", extraction_id).execute()
+        if not result.data:
+            return None
+        extraction = result.data[0]
+        doc = self.supabase.table("documents").select("company_id").eq("id", extraction["document_id"]).execute()
+        extraction["company_id"] = doc.data[0]["company_id"] if doc.data else None
+        return extraction
+
+    def finalize_approval(self, extraction_id: str, document_id: str, table: Optional[str], rows: List[dict], user_corrections: Optional[dict]) -> List[str]:
+        """
+        Insert approved rows into the final table and close out extraction + document status.
+        The status is claimed first (pending_review -> approved) so a repeated approval
+        cannot insert the rows twice; it is handed back if the insert fails.
+        """
+        if table and table not in FINAL_TABLES:
+            raise ValueError(f"Unknown target table: {table}")
+        claimed = self.supabase.table("extraction_results").update({
+            "status": "approved",
+            "user_corrections": user_corrections,
+            "reviewed_at": datetime.now().isoformat()
+        }).eq("id", extraction_id).eq("status", "pending_review").execute()
+        if not claimed.data:
+            raise ApprovalConflictError(f"Extraction {extraction_id} is not pending review")
+
+        inserted_ids = []
+        if table and rows:
+            try:
+                res = self.supabase.table(table).insert(rows).execute()
+            except Exception:
+                self.supabase.table("extraction_results").update({
+                    "status": "pending_review",
+                    "user_corrections": None,
+                    "reviewed_at": None
+                }).eq("id", extraction_id).execute()
+                raise
+            inserted_ids = [r["id"] for r in res.data]
+
+        self.supabase.table("documents").update({
+            "status": "parsed"
+        }).eq("id", document_id).execute()
+        return inserted_ids
+
+    def find_templates(self, company_id: str, doc_type: str = None) -> List[dict]:
+        query = self.supabase.table("document_templates").select("*").eq("company_id", company_id)
+        if doc_type:
+            query = query.eq("doc_type", doc_type)
+        return query.order("sample_count", desc=True).execute().data
+
+    def save_template(self, template: dict) -> dict:
+        return self.supabase.table("document_templates").insert(template).execute().data[0]
+
+    def update_template(self, template_id: str, changes: dict) -> dict:
+        changes = {**changes, "updated_at": datetime.now().isoformat()}
+        return self.supabase.table("document_templates").update(changes).eq("id", template_id).execute().data[0]
+
+    def extraction_method_counts(self) -> dict:
+        """Number of extraction results per extraction_method."""
+        counts = {}
+        for method in EXTRACTION_METHODS:
+            res = self.supabase.table("extraction_results").select("id", count="exact").eq("extraction_method", method).limit(1).execute()
+            counts[method] = res.count or 0
+        return counts
+
+    def insert_llm_usage(self, rows: List[dict]):
+        self.supabase.table("llm_usage").insert(rows).execute()
+
+    def get_company_token_budget(self, company_id: str) -> Optional[int]:
+        res = self.supabase.table("company_llm_budgets").select("monthly_token_limit").eq("company_id", company_id).execute()
+        return res.data[0]["monthly_token_limit"] if res.data else None
+
+    def set_company_token_budget(self, company_id: str, monthly_token_limit: Optional[int]) -> dict:
+        res = self.supabase.table("company_llm_budgets").upsert({
+            "company_id": company_id,
+            "monthly_token_limit": monthly_token_limit,
+            "updated_at": datetime.now(timezone.utc).isoformat()
+        }).execute()
+        return res.data[0]
+
+    def get_company_month_tokens(self, company_id: str) -> int:
+        month = datetime.now(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        res = self.supabase.table("llm_usage_monthly").select("total_tokens").eq("company_id", company_id).eq("month", month.isoformat()).execute()
+        return int(res.data[0]["total_tokens"] or 0) if res.data else 0
+
+    def close(self):
+        pass
+
+
+class ConnectionPool:
+    """
+    Thread-safe psycopg2 pool that keeps up to maxconn connections open.
+    psycopg2's ThreadedConnectionPool closes returned connections beyond minconn
+    and raises when exhausted; this one reuses them and makes callers wait
+    (up to timeout seconds) for a free connection instead.
+    """
+
+    def __init__(self, dsn: str, minconn: int, maxconn: int, timeout: float):
+        self.dsn = dsn
+        self.timeout = timeout
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        import psycopg2
+
+        return psycopg2.connect(self.dsn)
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No database connection free after {self.timeout}s")
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            return conn if conn is not None and not conn.closed else self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, close: bool = False):
+        try:
+            if close or conn.closed:
+                if not conn.closed:
+                    conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class PostgresRepository:
+    """Repository backed by a pooled direct Postgres connection (psycopg2)."""
+
+    backend = "postgres"
+
+    # name -> SQL, prepared lazily once per pooled connection
+    STATEMENTS = {
+        "create_document": """
+            INSERT INTO documents (company_id, name, storage_path, file_type, status)
+            VALUES ($1, $2, $3, $4, $5)
+            RETURNING *
+        """,
+        "claim_document": """
+            UPDATE documents SET status = 'processing'
+            WHERE id = $1
+            RETURNING *
+        """,
+        "get_document": """
+            SELECT * FROM documents WHERE id = $1
+        """,
+        "save_extraction": """
+            WITH ins AS (
+                INSERT INTO extraction_results
+                    (document_id, doc_type, extracted_data, status, extraction_method, confidence_score, template_id)
+                VALUES ($1, $2, $3, 'pending_review', $4, $5, $6)
+                RETURNING id
+            ), upd AS (
+                UPDATE documents SET status = 'extracted', file_type = $2
+                WHERE id = $1
+            )
+            SELECT id FROM ins
+        """,
+        "set_document_renditions": """
+            UPDATE documents SET thumbnail_path = $2, preview_path = $3
+            WHERE id = $1
+        """,
+        "mark_document_error": """
+            UPDATE documents SET status = 'error', error_message = $2
+            WHERE id = $1
+        """,
+        "get_pending_extraction": """
+            SELECT * FROM extraction_results
+            WHERE document_id = $1 AND status = 'pending_review'
+            LIMIT 1
+        """,
+        "get_extraction_for_approval": """
+            SELECT e.*, d.company_id
+            FROM extraction_results e
+            LEFT JOIN documents d ON d.id = e.document_id
+            WHERE e.id = $1
+        """,
+        "complete_approval": """
+            WITH upd AS (
+                UPDATE extraction_results
+                SET status = 'approved', user_corrections = $2, reviewed_at = NOW()
+                WHERE id = $1 AND status = 'pending_review'
+                RETURNING document_id
+            ), doc AS (
+                UPDATE documents SET status = 'parsed'
+                WHERE id IN (SELECT document_id FROM upd)
+            )
+            SELECT document_id FROM upd
+        """,
+        "find_templates": """
+            SELECT * FROM document_templates
+            WHERE company_id = $1 AND ($2::varchar IS NULL OR doc_type = $2)
+            ORDER BY sample_count DESC
+        """,
+        "save_template": """
+            INSERT INTO document_templates (company_id, doc_type, layout_hash, anchors, field_regions, sample_count)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            RETURNING *
+        """,
+        "update_template": """
+            UPDATE document_templates
+            SET field_regions = $2, sample_count = $3, updated_at = NOW()
+            WHERE id = $1
+            RETURNING *
+        """,
+        "extraction_method_counts": """
+            SELECT COALESCE(extraction_method, 'llm') AS extraction_method, COUNT(*) AS count
+            FROM extraction_results
+            GROUP BY 1
+        """,
+        "get_company_token_budget": """
+            SELECT monthly_token_limit FROM company_llm_budgets WHERE company_id = $1
+        """,
+        "set_company_token_budget": """
+            INSERT INTO company_llm_budgets (company_id, monthly_token_limit)
+            VALUES ($1, $2)
+            ON CONFLICT (company_id) DO UPDATE
+            SET monthly_token_limit = EXCLUDED.monthly_token_limit, updated_at = NOW()
+            RETURNING *
+        """,
+        "get_company_month_tokens": """
+            SELECT COALESCE(SUM(total_tokens), 0) AS total_tokens
+            FROM llm_usage
+            WHERE company_id = $1 AND created_at >= date_trunc('month', NOW())
+        """,
+    }
+
+    def __init__(self, dsn: str, minconn: int = 1, maxconn: int = 10, timeout: float = 30.0):
+        self.pool = ConnectionPool(dsn, minconn, maxconn, timeout)
+        # connection -> set of prepared statement names; keyed by the object itself
+        # so an entry disappears with its connection
+        self._prepared = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _cursor(self):
+        """Borrow a pooled connection; the block runs as one transaction."""
+        from psycopg2.extras import RealDictCursor
+
+        conn = self.pool.getconn()
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                yield conn, cur
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+    def _execute(self, conn, cur, name: str, *params):
+        """EXECUTE a named prepared statement, preparing it on this connection first if needed."""
+        with self._lock:
+            prepared = self._prepared.setdefault(conn, set())
+        if name not in prepared:
+            cur.execute(f"PREPARE {name} AS {self.STATEMENTS[name]}")
+            prepared.add(name)
+        if params:
+            placeholders = ", ".join(["%s"] * len(params))
+            cur.execute(f"EXECUTE {name} ({placeholders})", params)
+        else:
+            cur.execute(f"EXECUTE {name}")
+
+    def _run(self, name: str, *params, fetch: str = None):
+        with self._cursor() as (conn, cur):
+            self._execute(conn, cur, name, *params)
+            if fetch == "one":
+                row = cur.fetchone()
+                return dict(row) if row else None
+            if fetch == "all":
+                return [dict(r) for r in cur.fetchall()]
+            return None
+
+    def create_document(self, doc_data: dict) -> dict:
+        return self._run(
+            "create_document",
+            doc_data.get("company_id"),
+            doc_data.get("name"),
+            doc_data.get("storage_path"),
+            doc_data.get("file_type"),
+            doc_data.get("status", "uploaded"),
+            fetch="one",
+        )
+
+    def claim_document(self, document_id: str) -> Optional[dict]:
+        return self._run("claim_document", document_id, fetch="one")
+
+    def get_document(self, document_id: str) -> Optional[dict]:
+        return self._run("get_document", document_id, fetch="one")
+
+    def save_extraction(self, document_id: str, doc_type: str, data: dict, extraction_method: str = "llm", confidence_score: float = None, template_id: str = None) -> str:
+        from psycopg2.extras import Json
+
+        row = self._run(
+            "save_extraction",
+            document_id, doc_type, Json(data), extraction_method, confidence_score, template_id,
+            fetch="one",
+        )
+        return row["id"]
+
+    def set_document_renditions(self, document_id: str, thumbnail_path: Optional[str], preview_path: Optional[str]):
+        self._run("set_document_renditions", document_id, thumbnail_path, preview_path)
+
+    def mark_document_error(self, document_id: str, error_message: str):
+        self._run("mark_document_error", document_id, error_message)
+
+    def get_pending_extraction(self, document_id: str) -> Optional[dict]:
+        return self._run("get_pending_extraction", document_id, fetch="one")
+
+    def get_extraction_for_approval(self, extraction_id: str) -> Optional[dict]:
+        return self._run("get_extraction_for_approval", extraction_id, fetch="one")
+
+    def finalize_approval(self, extraction_id: str, document_id: str, table: Optional[str], rows: List[dict], user_corrections: Optional[dict]) -> List[str]:
+        """
+        Close out statuses and insert approved rows in a single transaction.
+        The status update runs first: it row-locks the extraction, so of two concurrent
+        approvals only one sees 'pending_review'; the other raises and rolls back.
+        """
+        from psycopg2.extras import Json, execute_values
+
+        inserted_ids = []
+        with self._cursor() as (conn, cur):
+            corrections = Json(user_corrections) if user_corrections is not None else None
+            self._execute(conn, cur, "complete_approval", extraction_id, corrections)
+            if cur.fetchone() is None:
+                raise ApprovalConflictError(f"Extraction {extraction_id} is not pending review")
+            if table and rows:
+                if table not in FINAL_TABLES:
+                    raise ValueError(f"Unknown target table: {table}")
+                columns = list(rows[0].keys())
+                values = [tuple(row.get(c) for c in columns) for row in rows]
+                inserted = execute_values(
+                    cur,
+                    f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s RETURNING id",
+                    values,
+                    fetch=True,
+                )
+                inserted_ids = [r["id"] for r in inserted]
+        return inserted_ids
+
+    def find_templates(self, company_id: str, doc_type: str = None) -> List[dict]:
+        return self._run("find_templates", company_id, doc_type, fetch="all")
+
+    def save_template(self, template: dict) -> dict:
+        from psycopg2.extras import Json
+
+        return self._run(
+            "save_template",
+            template["company_id"],
+            template["doc_type"],
+            template.get("layout_hash"),
+            Json(template.get("anchors") or []),
+            Json(template.get("field_regions") or {}),
+            template.get("sample_count", 1),
+            fetch="one",
+        )
+
+    def update_template(self, template_id: str, changes: dict) -> dict:
+        from psycopg2.extras import Json
+
+        return self._run(
+            "update_template",
+            template_id,
+            Json(changes["field_regions"]),
+            changes["sample_count"],
+            fetch="one",
+        )
+
+    def extraction_method_counts(self) -> dict:
+        """Number of extraction results per extraction_method."""
+        rows = self._run("extraction_method_counts", fetch="all")
+        return {row["extraction_method"]: row["count"] for row in rows}
+
+    def insert_llm_usage(self, rows: List[dict]):
+        from psycopg2.extras import execute_values
+
+        columns = list(rows[0].keys())
+        with self._cursor() as (conn, cur):
+            execute_values(
+                cur,
+                f"INSERT INTO llm_usage ({', '.join(columns)}) VALUES %s",
+                [tuple(row.get(c) for c in columns) for row in rows],
+            )
+
+    def get_company_token_budget(self, company_id: str) -> Optional[int]:
+        row = self._run("get_company_token_budget", company_id, fetch="one")
+        return row["monthly_token_limit"] if row else None
+
+    def set_company_token_budget(self, company_id: str, monthly_token_limit: Optional[int]) -> dict:
+        return self._run("set_company_token_budget", company_id, monthly_token_limit, fetch="one")
+
+    def get_company_month_tokens(self, company_id: str) -> int:
+        row = self._run("get_company_month_tokens", company_id, fetch="one")
+        return int(row["total_tokens"])
+
+    def close(self):
+        self.pool.closeall()
+        self._prepared.clear()
+
+
+_repository = None
+_repository_lock = threading.Lock()
+
+
+def get_repository():
+    """Return the process-wide repository for the configured DB_BACKEND."""
+    global _repository
+    if _repository is None:
+        with _repository_lock:
+            if _repository is None:
+                backend = os.environ.get("DB_BACKEND", "postgrest").lower()
+                if backend == "postgres":
+                    dsn = os.environ.get("DATABASE_URL")
+                    if not dsn:
+                        raise ValueError("DB_BACKEND=postgres requires DATABASE_URL to be set.")
+                    _repository = PostgresRepository(
+                        dsn,
+                        minconn=int(os.environ.get("DB_POOL_MIN", "1")),
+                        maxconn=int(os.environ.get("DB_POOL_MAX", "10")),
+                        timeout=float(os.environ.get("DB_POOL_TIMEOUT", "30")),
+                    )
+                elif backend == "postgrest":
+                    _repository = PostgrestRepository()
+                else:
+                    raise ValueError(f"Unknown DB_BACKEND: {backend}")
+                print(f"[DB] Using {_repository.backend} backend")
+    return _repository
+
+
+def close_repository():
+    global _repository
+    with _repository_lock:
+        if _repository is not None:
+            _repository.close()
+            _repository = None
@@ -1,8 +1,11 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Request
 from pydantic import BaseModel
 from typing import Optional, List
 from database import get_supabase
-from services.llm import LLMService
+from cache import response_cache, cached_json_response, PROVIDERS_CACHE_KEY
+from repository import get_repository
+from services.llm import reset_llm_service
+from services.usage import get_usage_recorder, get_llm_limiter
 import os
 
 router = APIRouter(prefix="/llm", tags=["llm"])
@@ -19,14 +22,16 @@ class LLMProviderUpdate(BaseModel):
     api_key: Optional[str] = None
     selected_model: Optional[str] = None
 
+class BudgetUpdate(BaseModel):
+    monthly_token_limit: Optional[int] = None  # None = unlimited
+
 class TestConnectionRequest(BaseModel):
     base_url: str
     api_key: str
 
 @router.get("/providers")
-async def get_providers():
-    try:
-        supabase = get_supabase()
+async def get_providers(request: Request, supabase=Depends(get_supabase)):
+    def load():
         # Select all fields except api_key for security (or mask it)
         # For MVP we might return it but it's bad practice. Let's return a masked version.
         response = supabase.table("llm_providers").select("*").order("created_at").execute()
@@ -40,16 +45,20 @@ async def get_providers():
             # For now let's send the real key too because the frontend might need to pre-fill the edit form.
             # In a real prod app we wouldn't send it back.
             providers.append(p)
-            
-        return {"status": "success", "data": providers}
+        
+        # No Last-Modified: deletes and activation don't bump any updated_at, so only the
+        # content-hash ETag reliably changes with this list
+        return {"status": "success", "data": providers}, None
+    
+    try:
+        # Cached until a provider route below changes the table
+        return cached_json_response(request, PROVIDERS_CACHE_KEY, load)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/providers")
-async def create_provider(provider: LLMProviderCreate):
+async def create_provider(provider: LLMProviderCreate, supabase=Depends(get_supabase)):
     try:
-        supabase = get_supabase()
-        
         # If this is the first provider, make it active
         count_res = supabase.table("llm_providers").select("count", count="exact").execute()
         is_first = count_res.count == 0
@@ -63,15 +72,16 @@ async def create_provider(provider: LLMProviderCreate):
         }
         
         response = supabase.table("llm_providers").insert(data).execute()
+        response_cache.invalidate(PROVIDERS_CACHE_KEY)
+        if is_first:
+            reset_llm_service()
         return {"status": "success", "data": response.data[0]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.put("/providers/{provider_id}")
-async def update_provider(provider_id: str, provider: LLMProviderUpdate):
+async def update_provider(provider_id: str, provider: LLMProviderUpdate, supabase=Depends(get_supabase)):
     try:
-        supabase = get_supabase()
-        
         data = {}
         if provider.name: data["name"] = provider.name
         if provider.base_url: data["base_url"] = provider.base_url
@@ -81,20 +91,22 @@ async def update_provider(provider_id: str, provider: LLMProviderUpdate):
         data["updated_at"] = "now()"
         
         response = supabase.table("llm_providers").update(data).eq("id", provider_id).execute()
+        response_cache.invalidate(PROVIDERS_CACHE_KEY)
+        reset_llm_service()
         return {"status": "success", "data": response.data[0]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.delete("/providers/{provider_id}")
-async def delete_provider(provider_id: str):
+async def delete_provider(provider_id: str, supabase=Depends(get_supabase)):
     try:
-        supabase = get_supabase()
         # Check if active
         current = supabase.table("llm_providers").select("is_active").eq("id", provider_id).single().execute()
         if current.data and current.data["is_active"]:
             raise HTTPException(status_code=400, detail="Cannot delete the active provider. Please activate another one first.")
             
         supabase.table("llm_providers").delete().eq("id", provider_id).execute()
+        response_cache.invalidate(PROVIDERS_CACHE_KEY)
         return {"status": "success", "message": "Provider deleted"}
     except HTTPException:
         raise
@@ -102,20 +114,46 @@ async def delete_provider(provider_id: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/providers/{provider_id}/activate")
-async def activate_provider(provider_id: str):
+async def activate_provider(provider_id: str, supabase=Depends(get_supabase)):
     try:
-        supabase = get_supabase()
-        
         # Deactivate all
         supabase.table("llm_providers").update({"is_active": False}).neq("id", "00000000-0000-0000-0000-000000000000").execute()
         
         # Activate target
         response = supabase.table("llm_providers").update({"is_active": True}).eq("id", provider_id).execute()
+        response_cache.invalidate(PROVIDERS_CACHE_KEY)
+        reset_llm_service()
         
         return {"status": "success", "message": "Provider activated", "data": response.data[0]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/usage/{company_id}")
+async def get_usage(company_id: str, repo=Depends(get_repository)):
+    """Month-to-date token usage vs budget, plus the current LLM concurrency limit."""
+    try:
+        recorder = get_usage_recorder()
+        recorder.flush()
+        return {
+            "status": "success",
+            "data": {
+                "month_tokens": repo.get_company_month_tokens(company_id),
+                "monthly_token_limit": repo.get_company_token_budget(company_id),
+                "concurrency": get_llm_limiter().stats()
+            }
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.put("/budgets/{company_id}")
+async def set_budget(company_id: str, budget: BudgetUpdate, repo=Depends(get_repository)):
+    try:
+        data = repo.set_company_token_budget(company_id, budget.monthly_token_limit)
+        get_usage_recorder().invalidate_budget(company_id)
+        return {"status": "success", "data": data}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.post("/test")
 async def test_connection(request: TestConnectionRequest):
     """
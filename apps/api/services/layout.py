@@ -0,0 +1,214 @@
+"""
+Page layout extraction for local (non-LLM) document processing.
+
+Turns an uploaded file into positioned words (PDF text layer, or OCR for images)
+plus a layout fingerprint: a perceptual hash of the first page and the positions
+of its text anchors (label words such as "发票代码", "开户行").
+
+All coordinates are normalized to 0..1 of the page size so templates survive
+differences in render resolution. Heavy dependencies (PyMuPDF, Pillow,
+pytesseract) are optional; without them load_layout() returns None and the
+caller falls back to the LLM.
+"""
+import io
+import os
+import re
+
+MAX_PAGES = 20
+MAX_ANCHORS = 40
+OCR_LANG = os.environ.get("OCR_LANG", "chi_sim+eng")
+OCR_DPI = int(os.environ.get("OCR_DPI", "300"))
+HASH_DPI = 72
+
+
+class PageLayout:
+    def __init__(self, width: float, height: float, words: list, image=None):
+        self.width = width
+        self.height = height
+        # [{"text", "x0", "y0", "x1", "y1", "line"}], normalized coordinates
+        # ("line" is the extractor's line id; rows are regrouped by position downstream)
+        self.words = words
+        self.image = image
+
+
+class DocumentLayout:
+    def __init__(self, pages: list, has_text_layer: bool):
+        self.pages = pages
+        self.has_text_layer = has_text_layer
+        first = pages[0]
+        self.phash = perceptual_hash(first.image) if first.image is not None else None
+        self.anchors = text_anchors(first.words)
+        # Renders are only needed for the hash; drop them so layouts returned
+        # from pool workers stay small to pickle
+        for page in pages:
+            page.image = None
+
+    @property
+    def words(self) -> list:
+        """Words of the first page."""
+        return self.pages[0].words
+
+
+def is_pdf(file_name: str, content_type: str = None) -> bool:
+    return (content_type or "").lower() == "application/pdf" or file_name.lower().endswith(".pdf")
+
+
+def load_layout(file_bytes: bytes, file_name: str, content_type: str = None, pdf=None):
+    """
+    Build a DocumentLayout, or None if the file type/dependencies don't allow it.
+    pdf: the file already opened with PyMuPDF, so callers reading it anyway don't parse it twice.
+    """
+    try:
+        if pdf is not None:
+            return _layout_from_pdf(pdf)
+        if is_pdf(file_name, content_type):
+            return _load_pdf(file_bytes)
+        return _load_image(file_bytes)
+    except ImportError as e:
+        print(f"[Layout] Optional dependency missing, skipping layout analysis: {e}")
+        return None
+    except Exception as e:
+        print(f"[Layout] Could not analyze layout: {e}")
+        return None
+
+
+def _load_pdf(file_bytes: bytes):
+    import pymupdf as fitz
+
+    with fitz.open(stream=file_bytes, filetype="pdf") as pdf:
+        return _layout_from_pdf(pdf)
+
+
+def _layout_from_pdf(pdf):
+    from PIL import Image
+
+    pages = []
+    has_text_layer = False
+    for index, page in enumerate(pdf):
+        if index >= MAX_PAGES:
+            break
+        width, height = page.rect.width, page.rect.height
+        words = [
+            {
+                "text": w[4],
+                "x0": w[0] / width,
+                "y0": w[1] / height,
+                "x1": w[2] / width,
+                "y1": w[3] / height,
+                "line": (w[5], w[6]),
+            }
+            for w in page.get_text("words")
+            if w[4].strip()
+        ]
+        has_text_layer = has_text_layer or bool(words)
+        image = None
+        if index == 0:
+            # Low resolution is enough for the perceptual hash
+            pix = page.get_pixmap(dpi=HASH_DPI)
+            image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        pages.append(PageLayout(width, height, words, image))
+
+    if not pages:
+        return None
+    if not has_text_layer:
+        # Scanned PDF: OCR a high-resolution render of the first page
+        pix = pdf[0].get_pixmap(dpi=OCR_DPI)
+        pages[0].words = _ocr_words(Image.frombytes("RGB", [pix.width, pix.height], pix.samples))
+    return DocumentLayout(pages, has_text_layer)
+
+
+def _load_image(file_bytes: bytes):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(file_bytes))
+    image.load()
+    image = image.convert("RGB")
+    words = _ocr_words(image)
+    return DocumentLayout([PageLayout(image.width, image.height, words, image)], False)
+
+
+def _ocr_words(image) -> list:
+    """Full-page OCR with positions; empty list if tesseract is unavailable."""
+    try:
+        import pytesseract
+        from pytesseract import Output
+    except ImportError:
+        print("[Layout] pytesseract not installed, no OCR words")
+        return []
+
+    try:
+        data = pytesseract.image_to_data(image, lang=OCR_LANG, output_type=Output.DICT)
+    except Exception as e:
+        print(f"[Layout] OCR failed: {e}")
+        return []
+
+    width, height = image.size
+    words = []
+    for i, text in enumerate(data["text"]):
+        text = (text or "").strip()
+        if not text or float(data["conf"][i]) < 0:
+            continue
+        left, top = data["left"][i], data["top"][i]
+        words.append({
+            "text": text,
+            "x0": left / width,
+            "y0": top / height,
+            "x1": (left + data["width"][i]) / width,
+            "y1": (top + data["height"][i]) / height,
+            "line": (data["block_num"][i], data["par_num"][i], data["line_num"][i]),
+        })
+    return words
+
+
+def perceptual_hash(image) -> str:
+    """64-bit difference hash of the page as a 16-char hex string."""
+    small = image.convert("L").resize((9, 8))
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return f"{bits:016x}"
+
+
+def hash_similarity(a: str, b: str) -> float:
+    """1.0 for identical hashes, 0.0 for completely different ones."""
+    if not a or not b:
+        return 0.0
+    return 1.0 - bin(int(a, 16) ^ int(b, 16)).count("1") / 64.0
+
+
+def text_anchors(words: list) -> list:
+    """Label-like words (no digits) with their centre positions."""
+    anchors = []
+    for w in words:
+        text = w["text"].strip()
+        if len(text) < 2 or re.search(r"\d", text):
+            continue
+        anchors.append({
+            "text": text,
+            "x": round((w["x0"] + w["x1"]) / 2, 4),
+            "y": round((w["y0"] + w["y1"]) / 2, 4),
+        })
+        if len(anchors) >= MAX_ANCHORS:
+            break
+    return anchors
+
+
+def anchor_similarity(anchors: list, words: list, tolerance: float = 0.03) -> float:
+    """Share of template anchors found at (roughly) the same position in words."""
+    if not anchors:
+        return 0.0
+    found = 0
+    for anchor in anchors:
+        for w in words:
+            if w["text"].strip() != anchor["text"]:
+                continue
+            cx = (w["x0"] + w["x1"]) / 2
+            cy = (w["y0"] + w["y1"]) / 2
+            if abs(cx - anchor["x"]) <= tolerance and abs(cy - anchor["y"]) <= tolerance:
+                found += 1
+                break
+    return found / len(anchors)
@@ -1,22 +1,33 @@
 import os
-from openai import OpenAI
-from dotenv import load_dotenv
 import base64
-import requests
+import threading
+import time
+from dotenv import load_dotenv
+
+from database import get_supabase
+from services.usage import get_usage_recorder, get_llm_limiter
 
-load_dotenv()
+# How long a worker reuses its client before re-checking the active provider in the DB.
+# Provider routes reset the client immediately, but only in the worker that served them.
+PROVIDER_CHECK_SECONDS = float(os.environ.get("LLM_PROVIDER_CHECK_SECONDS", "30"))
 
-OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
-OPENROUTER_BASE_URL = os.environ.get("OPENROUTER_BASE_URL")
-OPENROUTER_MODEL = os.environ.get("OPENROUTER_MODEL", "google/gemini-2.0-flash-001")
 
-from database import get_supabase
+def _active_provider_version():
+    """(id, updated_at) of the active provider row, or None if there is none."""
+    response = get_supabase().table("llm_providers").select("id, updated_at").eq("is_active", True).limit(1).execute()
+    rows = response.data or []
+    return (rows[0]["id"], rows[0].get("updated_at")) if rows else None
+
 
 class LLMService:
     def __init__(self):
+        from openai import OpenAI  # deferred: heavy import, only needed once a client is built
+        
         self.api_key = None
         self.base_url = None
         self.model = None
+        self.provider_name = "env"
+        self.provider_version = None  # (id, updated_at) of the DB provider in use
         
         # 1. Try to get active provider from DB
         try:
@@ -27,6 +38,8 @@ class LLMService:
                 self.api_key = provider.get("api_key")
                 self.base_url = provider.get("base_url")
                 self.model = provider.get("selected_model")
+                self.provider_name = provider.get("name")
+                self.provider_version = (provider.get("id"), provider.get("updated_at"))
                 print(f"[LLM] Loaded active provider from DB: {provider.get('name')}")
         except Exception as e:
             print(f"[LLM] Warning: Could not fetch provider from DB: {e}")
@@ -34,6 +47,7 @@ class LLMService:
         # 2. Fallback to environment variables
         if not self.api_key:
             print("[LLM] Fallback to environment variables")
+            load_dotenv()
             self.api_key = os.environ.get("OPENROUTER_API_KEY")
             self.base_url = os.environ.get("OPENROUTER_BASE_URL")
             self.model = os.environ.get("OPENROUTER_MODEL", "google/gemini-2.0-flash-001")
@@ -53,16 +67,42 @@ class LLMService:
             api_key=self.api_key,
         )
 
-    def generate_text(self, prompt: str, system_prompt: str = "You are a helpful financial assistant.") -> str:
+    def _complete(self, messages: list, call_type: str, context: dict = None):
+        """
+        Chat completion with budget check, adaptive concurrency and usage recording.
+        context: {"company_id", "document_id", "doc_type", "held"} used to attribute usage
+        (see UsageRecorder.record).
+        """
+        recorder = get_usage_recorder()
+        recorder.check_budget((context or {}).get("company_id"))
+        
+        limiter = get_llm_limiter()
+        limiter.acquire()
+        started = time.perf_counter()
+        response = None
+        throttled = False
         try:
-            print(f"[LLM] Generating text (prompt length: {len(prompt)})")
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ]
+            response = self.client.chat.completions.create(model=self.model, messages=messages)
+            return response
+        except Exception as e:
+            throttled = getattr(e, "status_code", None) == 429
+            raise
+        finally:
+            latency = time.perf_counter() - started
+            limiter.release(latency, throttled)
+            recorder.record(
+                context, self.provider_name, self.model, call_type,
+                getattr(response, "usage", None), latency,
+                "ok" if response is not None else "error"
             )
+
+    def generate_text(self, prompt: str, system_prompt: str = "You are a helpful financial assistant.", context: dict = None) -> str:
+        try:
+            print(f"[LLM] Generating text (prompt length: {len(prompt)})")
+            response = self._complete([
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt}
+            ], "text", context)
             result = response.choices[0].message.content
             print(f"[LLM] Text generation successful (response length: {len(result)})")
             return result
@@ -70,20 +110,22 @@ class LLMService:
             print(f"[LLM] Text generation error: {e}")
             raise e
 
-    def analyze_image(self, prompt: str, image_url: str, system_prompt: str = "You are a helpful financial assistant.") -> str:
+    def analyze_image(self, prompt: str, image_url: str, system_prompt: str = "You are a helpful financial assistant.", image_bytes: bytes = None, context: dict = None) -> str:
         """
         Analyze an image using multimodal LLM.
         Downloads the image and sends it as base64 to avoid URL access issues.
+        If image_bytes is given (already downloaded by the caller), the download is skipped.
         """
         try:
             print(f"[LLM] Analyzing image: {image_url}")
-            print(f"[LLM] Downloading image...")
             
-            # Download the image
-            response = requests.get(image_url, timeout=30)
-            response.raise_for_status()
-            image_bytes = response.content
-            print(f"[LLM] Image downloaded ({len(image_bytes)} bytes)")
+            if image_bytes is None:
+                import requests
+                print(f"[LLM] Downloading image...")
+                response = requests.get(image_url, timeout=30)
+                response.raise_for_status()
+                image_bytes = response.content
+                print(f"[LLM] Image downloaded ({len(image_bytes)} bytes)")
             
             # Encode to base64
             image_base64 = base64.b64encode(image_bytes).decode('utf-8')
@@ -99,24 +141,21 @@ class LLMService:
             print(f"[LLM] Sending to LLM (prompt length: {len(prompt)})")
             
             # Send to LLM with base64 data URL
-            llm_response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": prompt},
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:{mime_type};base64,{image_base64}"
-                                }
+            llm_response = self._complete([
+                {"role": "system", "content": system_prompt},
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": prompt},
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{mime_type};base64,{image_base64}"
                             }
-                        ]
-                    }
-                ]
-            )
+                        }
+                    ]
+                }
+            ], "image", context)
             
             result = llm_response.choices[0].message.content
             print(f"[LLM] Image analysis successful (response length: {len(result)})")
@@ -128,3 +167,47 @@ class LLMService:
             import traceback
             print(f"[LLM] Traceback:\n{traceback.format_exc()}")
             raise e
+
+
+_llm_service = None
+_llm_service_checked_at = 0.0
+_llm_service_lock = threading.Lock()
+
+
+def get_llm_service() -> LLMService:
+    """
+    Shared LLMService for the active provider, built on first use.
+    Every PROVIDER_CHECK_SECONDS the active provider is re-read, so provider changes
+    made through another worker are picked up without a restart.
+    """
+    global _llm_service, _llm_service_checked_at
+    service = _llm_service
+    if service is not None and time.monotonic() - _llm_service_checked_at < PROVIDER_CHECK_SECONDS:
+        return service
+    with _llm_service_lock:
+        if _llm_service is not None and time.monotonic() - _llm_service_checked_at < PROVIDER_CHECK_SECONDS:
+            return _llm_service
+        if _llm_service is not None:
+            try:
+                unchanged = _active_provider_version() == _llm_service.provider_version
+            except Exception as e:
+                print(f"[LLM] Warning: Could not check active provider, keeping current client: {e}")
+                unchanged = True
+            if unchanged:
+                _llm_service_checked_at = time.monotonic()
+                return _llm_service
+            print("[LLM] Active provider changed, rebuilding client")
+        _llm_service = LLMService()
+        _llm_service_checked_at = time.monotonic()
+        return _llm_service
+
+
+def reset_llm_service():
+    """
+    Drop the cached client so the next call picks up provider changes.
+    The old client is not closed here: calls still running on it keep their reference,
+    and its connections are released once the last of them finishes.
+    """
+    global _llm_service
+    with _llm_service_lock:
+        _llm_service = None
@@ -1,16 +1,51 @@
 import json
 import re
 import traceback
-from datetime import datetime
-from services.llm import LLMService
+from services.llm import get_llm_service
 from services.storage import StorageService
-from database import get_supabase
+from services import pdf_text
+from services.layout import load_layout, is_pdf
+from services.templates import TemplateService, MIN_CONFIDENCE
+from services.usage import get_usage_recorder
+from repository import get_repository, ApprovalConflictError
+from cache import response_cache, extraction_cache_key
+
+# extraction_method values produced without calling the LLM
+LLM_FREE_METHODS = {"template", "e_invoice"}
+
+SYSTEM_PROMPT = "You are an expert financial document analyzer. Extract structured data with high precision. Output ONLY valid JSON."
+
+EXTRACTION_INSTRUCTIONS = """
+1. 识别文档类型: 'invoice'(发票), 'contract'(合同), 'bank_statement'(银行流水), 'payroll_record'(工资单), 或 'other'(其他)。
+2. 根据类型提取相关字段。
+
+如果是 'invoice': 提取 {invoice_code, invoice_number, total_amount_tax_included, items: [{item_name, amount}]}
+如果是 'contract': 提取 {contract_no, title, party_a, party_b, total_amount, start_date, end_date, contract_type}
+如果是 'bank_statement': 提取 {account_name, account_number, bank_name, currency, transactions: [{transaction_date, counterparty_name, debit_amount, credit_amount, summary}]}
+如果是 'payroll_record': 提取 {employee_id, pay_period, base_salary, position_subsidy, total_deductions, net_pay}
+
+返回JSON对象:
+{
+    "type": "...",
+    "data": { ... }
+}
+"""
+
+IMAGE_PROMPT = "\n分析这张图片。" + EXTRACTION_INSTRUCTIONS
+
+# {text} is substituted with str.replace: the instructions contain literal braces
+TEXT_PROMPT = "\n以下是从PDF文字层提取的文档内容(表格以 | 分隔):\n\n{text}\n\n分析该文档。" + EXTRACTION_INSTRUCTIONS
 
 class ParserService:
     def __init__(self):
-        self.llm = LLMService()
         self.storage = StorageService()
-        self.supabase = get_supabase()
+        self.repo = get_repository()
+        self.templates = TemplateService(self.repo)
+
+    @property
+    def llm(self):
+        # Resolved on use: template and e-invoice extractions never need an LLM client
+        return get_llm_service()
 
     def _extract_json(self, text: str) -> dict:
         """Extracts JSON object from a string that might contain Markdown code blocks."""
@@ -77,79 +112,57 @@ class ParserService:
         """
         print(f"\n[Parser] ========== Starting parse for document {document_id} ==========")
         
+        # Attributes LLM usage; records are held until the doc_type is known
+        usage_context = {"document_id": document_id, "held": []}
+        
         try:
-            # 1. Get Document
-            print(f"[Parser] Step 1: Fetching document from database...")
-            doc_response = self.supabase.table("documents").select("*").eq("id", document_id).execute()
-            if not doc_response.data:
+            # 1. Get Document and mark it as processing
+            print(f"[Parser] Step 1: Claiming document (status -> 'processing')...")
+            doc = self.repo.claim_document(document_id)
+            if not doc:
                 raise ValueError(f"Document {document_id} not found in database")
-            doc = doc_response.data[0]
-            print(f"[Parser] Document found: {doc['name']}, status: {doc['status']}")
-            
-            # Update status to processing
-            print(f"[Parser] Step 2: Updating status to 'processing'...")
-            self.supabase.table("documents").update({"status": "processing"}).eq("id", document_id).execute()
-            
-            # 2. Get URL
-            print(f"[Parser] Step 3: Getting public URL for storage path: {doc['storage_path']}")
-            file_url = self.storage.get_public_url(doc["storage_path"])
-            print(f"[Parser] Public URL: {file_url}")
+            print(f"[Parser] Document found: {doc['name']}")
+            usage_context["company_id"] = doc["company_id"]
             
-            # 3. Analyze with LLM
-            print(f"[Parser] Step 4: Calling LLM for analysis...")
-            system_prompt = "You are an expert financial document analyzer. Extract structured data with high precision. Output ONLY valid JSON."
+            # 2. Download file and analyze its layout
+            print(f"[Parser] Step 2: Downloading file: {doc['storage_path']}")
+            file_bytes = self.storage.download_file(doc["storage_path"])
+            print(f"[Parser] File downloaded ({len(file_bytes)} bytes)")
+            # Layout analysis (and OCR for images) is only worth it if the company has templates
+            templates = self.repo.find_templates(doc["company_id"])
+            analysis = self._analyze_file(doc, file_bytes, with_layout=bool(templates))
+            layout = analysis.get("layout")
             
-            prompt = """
-分析这张图片。
-1. 识别文档类型: 'invoice'(发票), 'contract'(合同), 'bank_statement'(银行流水), 'payroll_record'(工资单), 或 'other'(其他)。
-2. 根据类型提取相关字段。
-
-如果是 'invoice': 提取 {invoice_code, invoice_number, total_amount_tax_included, items: [{item_name, amount}]}
-如果是 'contract': 提取 {contract_no, title, party_a, party_b, total_amount, start_date, end_date, contract_type}
-如果是 'bank_statement': 提取 {account_name, account_number, bank_name, currency, transactions: [{transaction_date, counterparty_name, debit_amount, credit_amount, summary}]}
-如果是 'payroll_record': 提取 {employee_id, pay_period, base_salary, position_subsidy, total_deductions, net_pay}
-
-返回JSON对象:
-{
-    "type": "...",
-    "data": { ... }
-}
-"""
-            
-            llm_response = self.llm.analyze_image(prompt, file_url, system_prompt)
-            print(f"[Parser] LLM Response received (length: {len(llm_response)})")
-            print(f"[Parser] LLM Response: {llm_response[:1000]}")
-            
-            parsed_data = self._extract_json(llm_response)
-            print(f"[Parser] Parsed JSON: {json.dumps(parsed_data, ensure_ascii=False, indent=2)}")
-            
-            doc_type = parsed_data.get("type")
-            data = parsed_data.get("data", {})
-            
-            if not doc_type:
-                raise ValueError("LLM did not return a document type")
+            template_id = None
+            confidence = None
             
-            # 4. Save to extraction_results for user review (NEW!)
-            print(f"[Parser] Step 5: Saving extraction results for review (type: {doc_type})...")
-            
-            extraction_result = {
-                "document_id": document_id,
-                "doc_type": doc_type,
-                "extracted_data": data,
-                "status": "pending_review"
-            }
+            # 3. Extract: learned layout template -> PDF text layer -> vision LLM
+            local = self._extract_with_template(doc["company_id"], layout, templates)
+            if local:
+                doc_type, data, confidence, template_id = local
+                method = "template"
+                print(f"[Parser] Step 3: Extracted locally with template {template_id} (confidence: {confidence})")
+            else:
+                text_result = self._extract_from_text_layer(analysis.get("text"), usage_context)
+                if text_result:
+                    method, parsed_data, confidence = text_result
+                else:
+                    method = "llm"
+                    parsed_data = self._analyze_with_vision(doc, file_bytes, usage_context)
+                
+                doc_type = parsed_data.get("type")
+                data = parsed_data.get("data", {})
+                get_usage_recorder().release(usage_context["held"], doc_type)
+                
+                if not doc_type:
+                    raise ValueError("LLM did not return a document type")
             
-            result = self.supabase.table("extraction_results").insert(extraction_result).execute()
-            extraction_id = result.data[0]["id"]
+            # 4. Save to extraction_results for user review, document -> 'extracted'
+            print(f"[Parser] Step 4: Saving extraction results for review (type: {doc_type}, method: {method})...")
+            extraction_id = self.repo.save_extraction(document_id, doc_type, data, method, confidence, template_id)
+            response_cache.invalidate(extraction_cache_key(document_id))
             print(f"[Parser] Extraction result saved with ID: {extraction_id}")
             
-            # Update Document Status to 'extracted' (waiting for review)
-            print(f"[Parser] Step 6: Updating document status to 'extracted'...")
-            self.supabase.table("documents").update({
-                "status": "extracted",
-                "file_type": doc_type
-            }).eq("id", document_id).execute()
-            
             print(f"[Parser] ========== Parse completed, awaiting user review ==========\n")
             return {
                 "extraction_id": extraction_id,
@@ -165,11 +178,10 @@ class ParserService:
             print(f"[Parser] Traceback:\n{error_trace}")
             print(f"[Parser] ================================================================\n")
             
-            # Update status to error
-            self.supabase.table("documents").update({
-                "status": "error",
-                "error_message": error_msg[:500]
-            }).eq("id", document_id).execute()
+            # Update status to error; LLM calls made before the failure are still accounted
+            get_usage_recorder().release(usage_context["held"])
+            self.repo.mark_document_error(document_id, error_msg[:500])
+            response_cache.invalidate(extraction_cache_key(document_id))
             
             raise e
 
@@ -181,67 +193,160 @@ class ParserService:
         print(f"\n[Parser] ========== Approving extraction {extraction_id} ==========")
         
         try:
-            # Get extraction result
-            result = self.supabase.table("extraction_results").select("*").eq("id", extraction_id).execute()
-            if not result.data:
+            # Get extraction result (with the document's company_id)
+            extraction = self.repo.get_extraction_for_approval(extraction_id)
+            if not extraction:
                 raise ValueError(f"Extraction {extraction_id} not found")
+            if extraction["status"] != "pending_review":
+                # finalize_approval re-checks this atomically; fail early on stale views
+                raise ApprovalConflictError(f"Extraction {extraction_id} is {extraction['status']}, not pending review")
             
-            extraction = result.data[0]
             doc_type = extraction["doc_type"]
             data = user_corrections if user_corrections else extraction["extracted_data"]
             document_id = extraction["document_id"]
+            company_id = extraction["company_id"]
             
-            # Get company_id from document
-            doc = self.supabase.table("documents").select("company_id").eq("id", document_id).execute()
-            company_id = doc.data[0]["company_id"]
-            
-            print(f"[Parser] Saving approved data to {doc_type} table...")
-            
-            # Save to appropriate table
+            # Build rows for the appropriate table
+            table, rows = None, []
             if doc_type == "invoice":
-                self._save_invoice(company_id, document_id, data)
+                table, rows = "invoices", self._invoice_rows(company_id, document_id, data)
             elif doc_type == "contract":
-                self._save_contract(company_id, document_id, data)
+                table, rows = "contracts", self._contract_rows(company_id, document_id, data)
             elif doc_type == "bank_statement":
-                self._save_bank_statement(company_id, document_id, data)
+                table, rows = "bank_statements", self._bank_statement_rows(company_id, document_id, data)
             elif doc_type == "payroll_record":
-                self._save_payroll(company_id, document_id, data)
-            
-            # Update extraction status
-            self.supabase.table("extraction_results").update({
-                "status": "approved",
-                "user_corrections": user_corrections,
-                "reviewed_at": datetime.now().isoformat()
-            }).eq("id", extraction_id).execute()
+                table, rows = "payroll_records", self._payroll_rows(company_id, document_id, data)
             
-            # Update document status
-            self.supabase.table("documents").update({
-                "status": "parsed"
-            }).eq("id", document_id).execute()
+            print(f"[Parser] Saving approved data to {table or doc_type} table...")
+            inserted_ids = self.repo.finalize_approval(extraction_id, document_id, table, rows, user_corrections)
+            response_cache.invalidate(extraction_cache_key(document_id))
+            print(f"[Parser] Saved {len(inserted_ids)} row(s) to {table}: {inserted_ids}")
             
             print(f"[Parser] ========== Approval completed ==========\n")
-            return {"status": "success"}
+            return {
+                "status": "success",
+                "company_id": company_id,
+                "document_id": document_id,
+                "doc_type": doc_type,
+                "data": data
+            }
             
         except Exception as e:
             print(f"[Parser] Approval error: {e}")
             raise e
 
-    def _save_invoice(self, company_id, document_id, data):
-        print(f"[Parser] Saving invoice data...")
-        invoice_data = {
+    def _extract_with_template(self, company_id, layout, templates):
+        """Extract with a matching learned template. Returns (doc_type, data, confidence, template_id) or None."""
+        if layout is None or not templates:
+            return None
+        try:
+            template, score = self.templates.match(company_id, layout, templates=templates)
+            if not template:
+                print(f"[Parser] No matching layout template (best score: {score:.2f})")
+                return None
+            data, confidence = self.templates.extract(template, layout, score)
+            if confidence < MIN_CONFIDENCE:
+                print(f"[Parser] Template {template['id']} matched but confidence {confidence} is low, falling back to LLM")
+                return None
+            return template["doc_type"], data, confidence, template["id"]
+        except Exception as e:
+            print(f"[Parser] Template extraction error, falling back to LLM: {e}")
+            return None
+
+    def _analyze_file(self, doc, file_bytes, with_layout):
+        """
+        PDF text layer and (optionally) layout, read in one pass in the PDF worker pool.
+        Returns {"text": ..., "layout": ...}; empty when there is nothing to read or it failed.
+        """
+        if not with_layout and not is_pdf(doc["name"], doc.get("file_type")):
+            return {}
+        try:
+            return pdf_text.analyze_document_pooled(file_bytes, doc["name"], doc.get("file_type"), with_layout)
+        except Exception as e:
+            print(f"[Parser] Document analysis failed, using vision model: {e}")
+            return {}
+
+    def _extract_from_text_layer(self, extracted, usage_context=None):
+        """
+        Fast path for digitally generated PDFs: use the text layer instead of a vision call.
+        extracted: pdf_text.extract_pdf_text() result, None for non-PDFs.
+        Returns (method, parsed_data, confidence) or None when the document needs the vision model.
+        """
+        if extracted is None:
+            return None
+        if not pdf_text.has_usable_text(extracted["text"]):
+            print(f"[Parser] PDF text layer not usable (scan?), using vision model")
+            return None
+        print(f"[Parser] Text layer found ({len(extracted['text'])} chars, {len(extracted['tables'])} tables)")
+
+        e_invoice = pdf_text.parse_e_invoice(extracted)
+        if e_invoice and e_invoice[1] >= MIN_CONFIDENCE:
+            data, confidence = e_invoice
+            print(f"[Parser] Step 3: Parsed e-invoice deterministically (confidence: {confidence})")
+            return "e_invoice", {"type": "invoice", "data": data}, confidence
+
+        if extracted["truncated"]:
+            print(f"[Parser] PDF has {extracted['pages']} pages, only the first {pdf_text.MAX_PAGES} were read, using vision model")
+            return None
+        text = pdf_text.to_prompt_text(extracted)
+        if len(text) > pdf_text.MAX_TEXT_CHARS:
+            # Cutting the text would silently drop rows (e.g. transactions); the vision path gets the whole file
+            print(f"[Parser] Text layer too long ({len(text)} > {pdf_text.MAX_TEXT_CHARS} chars), using vision model")
+            return None
+        print(f"[Parser] Step 3: Calling LLM with text layer...")
+        prompt = TEXT_PROMPT.replace("{text}", text)
+        llm_response = self.llm.generate_text(prompt, SYSTEM_PROMPT, context=usage_context)
+        print(f"[Parser] LLM Response: {llm_response[:1000]}")
+        parsed_data = self._extract_json(llm_response)
+        if not parsed_data.get("type"):
+            print(f"[Parser] Text-based extraction returned no type, using vision model")
+            return None
+        return "text_layer", parsed_data, None
+
+    def _analyze_with_vision(self, doc, file_bytes, usage_context=None):
+        file_url = self.storage.get_public_url(doc["storage_path"])
+        print(f"[Parser] Public URL: {file_url}")
+        
+        print(f"[Parser] Step 3: Calling vision LLM for analysis...")
+        llm_response = self.llm.analyze_image(IMAGE_PROMPT, file_url, SYSTEM_PROMPT, image_bytes=file_bytes, context=usage_context)
+        print(f"[Parser] LLM Response received (length: {len(llm_response)})")
+        print(f"[Parser] LLM Response: {llm_response[:1000]}")
+        
+        parsed_data = self._extract_json(llm_response)
+        print(f"[Parser] Parsed JSON: {json.dumps(parsed_data, ensure_ascii=False, indent=2)}")
+        return parsed_data
+
+    def learn_template(self, company_id: str, document_id: str, doc_type: str, data: dict):
+        """Learn/refine a layout template from approved values. Runs after approval."""
+        if doc_type not in ("invoice", "contract", "bank_statement", "payroll_record"):
+            return None
+        try:
+            doc = self.repo.get_document(document_id)
+            if not doc:
+                return None
+            file_bytes = self.storage.download_file(doc["storage_path"])
+            layout = pdf_text.get_pdf_pool().submit(
+                load_layout, file_bytes, doc["name"], doc.get("file_type")
+            ).result(timeout=pdf_text.EXTRACT_TIMEOUT)
+            if layout is None:
+                return None
+            return self.templates.learn(company_id, doc_type, layout, data)
+        except Exception as e:
+            print(f"[Parser] Template learning error: {e}")
+            return None
+
+    def _invoice_rows(self, company_id, document_id, data):
+        return [{
             "company_id": company_id,
             "document_id": document_id,
             "invoice_code": data.get("invoice_code"),
             "invoice_number": data.get("invoice_number"),
             "total_amount_tax_included": self._safe_float(data.get("total_amount_tax_included")),
             "verification_status": "pending"
-        }
-        res = self.supabase.table("invoices").insert(invoice_data).execute()
-        print(f"[Parser] Invoice saved with ID: {res.data[0]['id']}")
+        }]
 
-    def _save_contract(self, company_id, document_id, data):
-        print(f"[Parser] Saving contract data...")
-        contract_data = {
+    def _contract_rows(self, company_id, document_id, data):
+        return [{
             "company_id": company_id,
             "document_id": document_id,
             "contract_no": data.get("contract_no"),
@@ -253,32 +358,26 @@ class ParserService:
             "end_date": self._normalize_date(data.get("end_date")),
             "contract_type": data.get("contract_type"),
             "verification_status": "pending"
-        }
-        res = self.supabase.table("contracts").insert(contract_data).execute()
-        print(f"[Parser] Contract saved with ID: {res.data[0]['id']}")
+        }]
 
-    def _save_bank_statement(self, company_id, document_id, data):
-        print(f"[Parser] Saving bank statement data...")
-        transactions = data.get("transactions", [])
-        for txn in transactions:
-            self.supabase.table("bank_statements").insert({
-                "company_id": company_id,
-                "document_id": document_id,
-                "transaction_date": self._normalize_date(txn.get("transaction_date")),
-                "counterparty_name": txn.get("counterparty_name"),
-                "debit_amount": self._safe_float(txn.get("debit_amount")),
-                "credit_amount": self._safe_float(txn.get("credit_amount")),
-                "summary": txn.get("summary"),
-                "account_number": data.get("account_number"),
-                "account_name": data.get("account_name"),
-                "bank_name": data.get("bank_name"),
-                "currency": data.get("currency", "CNY")
-            }).execute()
-        print(f"[Parser] Saved {len(transactions)} bank transactions")
+    def _bank_statement_rows(self, company_id, document_id, data):
+        # One multi-row insert instead of a round trip per transaction
+        return [{
+            "company_id": company_id,
+            "document_id": document_id,
+            "transaction_date": self._normalize_date(txn.get("transaction_date")),
+            "counterparty_name": txn.get("counterparty_name"),
+            "debit_amount": self._safe_float(txn.get("debit_amount")),
+            "credit_amount": self._safe_float(txn.get("credit_amount")),
+            "summary": txn.get("summary"),
+            "account_number": data.get("account_number"),
+            "account_name": data.get("account_name"),
+            "bank_name": data.get("bank_name"),
+            "currency": data.get("currency", "CNY")
+        } for txn in data.get("transactions", [])]
 
-    def _save_payroll(self, company_id, document_id, data):
-        print(f"[Parser] Saving payroll data...")
-        res = self.supabase.table("payroll_records").insert({
+    def _payroll_rows(self, company_id, document_id, data):
+        return [{
             "company_id": company_id,
             "document_id": document_id,
             "employee_id": data.get("employee_id"),
@@ -287,5 +386,4 @@ class ParserService:
             "position_subsidy": self._safe_float(data.get("position_subsidy")),
             "total_deductions": self._safe_float(data.get("total_deductions")),
             "net_pay": self._safe_float(data.get("net_pay"))
-        }).execute()
-        print(f"[Parser] Payroll record saved with ID: {res.data[0]['id']}")
+        }]
@@ -0,0 +1,186 @@
+"""
+Native PDF text-layer extraction.
+
+Digitally generated PDFs (e-invoices / 电子发票, bank exports) carry a full text
+layer. Reading it locally is far cheaper than rasterizing the page for a vision
+model: the parser sends the compact text to LLMService.generate_text, or parses
+known e-invoice layouts deterministically without any LLM call.
+
+Extraction is CPU-bound, so it runs in a process pool (PDF_WORKERS), together
+with the layout analysis for template matching: analyze_document() opens the
+file once and returns both.
+"""
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from services.layout import MAX_PAGES, is_pdf, load_layout
+
+MIN_TEXT_CHARS = int(os.environ.get("PDF_MIN_TEXT_CHARS", "50"))
+MAX_TEXT_CHARS = int(os.environ.get("PDF_MAX_TEXT_CHARS", "20000"))
+EXTRACT_TIMEOUT = 60
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pdf_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                workers = int(os.environ.get("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+                # Not "fork": the pool is created from a request thread of a multithreaded
+                # server, and a forked child could inherit locks held by other threads
+                _pool = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("forkserver")
+                )
+    return _pool
+
+
+def shutdown_pdf_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def extract_pdf_text(pdf) -> dict:
+    """
+    Text and tables of the first MAX_PAGES pages of an opened PyMuPDF document.
+    Returns {"text": str, "body": str, "tables": [[[cell, ...], ...], ...], "pages": int, "truncated": bool}
+    where "text" is the full text layer and "body" the text outside the tables.
+    """
+    texts = []
+    bodies = []
+    tables = []
+    for index, page in enumerate(pdf):
+        if index >= MAX_PAGES:
+            break
+        texts.append(page.get_text("text"))
+        boxes = []
+        try:
+            for table in page.find_tables().tables:
+                rows = [[(cell or "").strip() for cell in row] for row in table.extract()]
+                if rows:
+                    tables.append(rows)
+                    boxes.append(table.bbox)
+        except AttributeError:
+            # find_tables needs PyMuPDF >= 1.23
+            pass
+        for x0, y0, x1, y1, text, *_ in page.get_text("blocks"):
+            cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+            if not any(b[0] <= cx <= b[2] and b[1] <= cy <= b[3] for b in boxes):
+                bodies.append(text)
+    return {
+        "text": "\n".join(texts),
+        "body": "\n".join(bodies),
+        "tables": tables,
+        "pages": pdf.page_count,
+        "truncated": pdf.page_count > MAX_PAGES,
+    }
+
+
+def analyze_document(file_bytes: bytes, file_name: str, content_type: str = None, with_layout: bool = True) -> dict:
+    """
+    One pass over an uploaded file. Runs inside a pool worker.
+    Returns {"text": extract_pdf_text() result, or None if not a PDF,
+             "layout": DocumentLayout, or None if not requested/available}
+    """
+    if not is_pdf(file_name, content_type):
+        layout = load_layout(file_bytes, file_name, content_type) if with_layout else None
+        return {"text": None, "layout": layout}
+
+    import pymupdf as fitz
+
+    with fitz.open(stream=file_bytes, filetype="pdf") as pdf:
+        text = extract_pdf_text(pdf)
+        layout = load_layout(file_bytes, file_name, content_type, pdf=pdf) if with_layout else None
+    return {"text": text, "layout": layout}
+
+
+def analyze_document_pooled(file_bytes: bytes, file_name: str, content_type: str = None, with_layout: bool = True) -> dict:
+    return get_pdf_pool().submit(
+        analyze_document, file_bytes, file_name, content_type, with_layout
+    ).result(timeout=EXTRACT_TIMEOUT)
+
+
+def has_usable_text(text: str) -> bool:
+    """True if the text layer carries real content (not empty / a scan with a few stray glyphs)."""
+    visible = re.sub(r"\s", "", text or "")
+    if len(visible) < MIN_TEXT_CHARS:
+        return False
+    # Broken font encodings show up as replacement characters
+    return visible.count("�") / len(visible) < 0.1
+
+
+def to_prompt_text(extracted: dict) -> str:
+    """
+    Compact text for the LLM: text outside tables plus tables as pipe-separated rows,
+    so table cells are sent once. Not truncated: callers compare against MAX_TEXT_CHARS.
+    """
+    parts = [extracted["body"].strip()]
+    for index, table in enumerate(extracted["tables"], start=1):
+        parts.append(f"\n[表格 {index}]")
+        parts.extend(" | ".join(row) for row in table)
+    return "\n".join(parts)
+
+
+_AMOUNT = r"[¥￥]?\s*(-?[\d,]+\.\d{2})"
+_E_INVOICE_PATTERNS = {
+    "invoice_code": r"发票代码[:：\s]*(\d{10,12})",
+    "invoice_number": r"发票号码[:：\s]*(\d{20}|\d{8})(?!\d)",
+    "total_amount_tax_included": r"[(（]小写[)）][:：\s]*" + _AMOUNT,
+    "issue_date": r"开票日期[:：\s]*(\d{4}\s*年\s*\d{1,2}\s*月\s*\d{1,2}\s*日|\d{4}-\d{2}-\d{2})",
+}
+_ITEM_NAME_HEADERS = ("项目名称", "货物或应税劳务、服务名称", "货物或应税劳务名称")
+
+
+def parse_e_invoice(extracted: dict):
+    """
+    Deterministic parse of a Chinese e-invoice (电子发票 / 数电票) text layer.
+    Returns (data, confidence) in the same shape as the LLM 'invoice' output, or None.
+    """
+    text = extracted["text"]
+    if "发票" not in text:
+        return None
+
+    data = {}
+    for field, pattern in _E_INVOICE_PATTERNS.items():
+        match = re.search(pattern, text)
+        data[field] = re.sub(r"\s", "", match.group(1)) if match else None
+
+    # 数电票 (fully digital invoices) have a 20-digit number and no invoice code
+    if not data["invoice_number"] or not data["total_amount_tax_included"]:
+        return None
+    data["total_amount_tax_included"] = data["total_amount_tax_included"].replace(",", "")
+    data["items"] = _invoice_items(extracted["tables"])
+
+    expected = ["invoice_number", "total_amount_tax_included", "issue_date"]
+    if len(data["invoice_number"]) != 20:
+        expected.append("invoice_code")
+    found = sum(1 for f in expected if data.get(f))
+    return data, round(found / len(expected), 4)
+
+
+def _invoice_items(tables: list) -> list:
+    """Line items from the goods table: rows under the item-name / 金额 header."""
+    for table in tables:
+        for header_index, header in enumerate(table):
+            cells = [re.sub(r"\s", "", c) for c in header]
+            name_col = next((i for i, c in enumerate(cells) if c in _ITEM_NAME_HEADERS), None)
+            amount_col = next((i for i, c in enumerate(cells) if c == "金额"), None)
+            if name_col is None or amount_col is None:
+                continue
+            items = []
+            for row in table[header_index + 1:]:
+                name = row[name_col] if name_col < len(row) else ""
+                amount = row[amount_col] if amount_col < len(row) else ""
+                if not name or re.sub(r"\s", "", name) == "合计" or not re.search(r"\d", amount):
+                    continue
+                items.append({"item_name": name.replace("\n", ""), "amount": amount.replace(",", "")})
+            return items
+    return []
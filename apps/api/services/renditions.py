@@ -0,0 +1,92 @@
+"""
+Thumbnail and preview renditions for the review UI.
+
+On upload, the first PDF page is rasterized (images are decoded directly) and
+downscaled to a small list thumbnail and a web-sized preview. Both are stored
+next to the original under renditions/ with long-lived cache headers, so the
+UI never has to pull the full scan just to show a document.
+"""
+import io
+import os
+
+from repository import get_repository
+from services.layout import is_pdf
+from services.pdf_text import get_pdf_pool
+from services.storage import StorageService
+
+RENDITIONS = {
+    # name: (max edge in px, quality)
+    "thumbnail": (int(os.environ.get("THUMBNAIL_SIZE", "320")), 70),
+    "preview": (int(os.environ.get("PREVIEW_SIZE", "1600")), 80),
+}
+RENDER_TIMEOUT = 120
+
+
+def rendition_path(storage_path: str, name: str, ext: str) -> str:
+    """renditions/<company_id>/<uuid>_<name>.<ext> for an original at <company_id>/<uuid>.<ext>"""
+    base = storage_path.rsplit(".", 1)[0]
+    return f"renditions/{base}_{name}.{ext}"
+
+
+def render_renditions(file_bytes: bytes, file_name: str, content_type: str = None) -> dict:
+    """
+    Encode all renditions. Runs inside a pool worker.
+    Returns {name: (bytes, content_type, ext)}; empty for unsupported files.
+    """
+    from PIL import Image, ImageOps, features
+
+    largest = max(size for size, _ in RENDITIONS.values())
+    if is_pdf(file_name, content_type):
+        import pymupdf as fitz
+
+        with fitz.open(stream=file_bytes, filetype="pdf") as pdf:
+            if pdf.page_count == 0:
+                return {}
+            page = pdf[0]
+            zoom = min(4.0, largest / max(page.rect.width, page.rect.height))
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    elif (content_type or "").startswith("image/") or file_name.lower().endswith((".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff")):
+        image = Image.open(io.BytesIO(file_bytes))
+        image.seek(0)
+        # Phone photos are stored sideways with an EXIF orientation tag; browsers honour it
+        image = ImageOps.exif_transpose(image).convert("RGB")
+    else:
+        return {}
+
+    use_webp = features.check("webp")
+    fmt, mime, ext = ("WEBP", "image/webp", "webp") if use_webp else ("JPEG", "image/jpeg", "jpg")
+    results = {}
+    for name, (size, quality) in RENDITIONS.items():
+        copy = image.copy()
+        copy.thumbnail((size, size), Image.LANCZOS)
+        out = io.BytesIO()
+        copy.save(out, format=fmt, quality=quality, optimize=True)
+        results[name] = (out.getvalue(), mime, ext)
+    return results
+
+
+def create_renditions(document_id: str, storage_path: str, file_bytes: bytes, file_name: str, content_type: str = None):
+    """Render, upload and record renditions for a document. Runs as an upload background task."""
+    try:
+        renditions = get_pdf_pool().submit(
+            render_renditions, file_bytes, file_name, content_type
+        ).result(timeout=RENDER_TIMEOUT)
+        if not renditions:
+            print(f"[Renditions] No renditions for {file_name} ({content_type})")
+            return None
+
+        storage = StorageService()
+        paths = {}
+        for name, (content, mime, ext) in renditions.items():
+            path = rendition_path(storage_path, name, ext)
+            storage.upload_rendition(path, content, mime)
+            paths[name] = path
+
+        get_repository().set_document_renditions(document_id, paths.get("thumbnail"), paths.get("preview"))
+        sizes = ", ".join(f"{n}: {len(r[0])} bytes" for n, r in renditions.items())
+        print(f"[Renditions] Stored renditions for {document_id} (original: {len(file_bytes)} bytes, {sizes})")
+        return paths
+    except Exception as e:
+        print(f"[Renditions] Rendition error for {document_id}: {e}")
+        return None
@@ -1,12 +1,17 @@
-from supabase import Client
+from typing import TYPE_CHECKING
 from database import get_supabase
 import uuid
 
+if TYPE_CHECKING:
+    from supabase import Client
+
 BUCKET_NAME = "raw-files"
+# Stored objects are never overwritten in place (unique names), so browsers may cache them for a year
+CACHE_CONTROL_MAX_AGE = "31536000"
 
 class StorageService:
     def __init__(self):
-        self.supabase: Client = get_supabase()
+        self.supabase: "Client" = get_supabase()
 
     def upload_file(self, file_content: bytes, file_name: str, content_type: str, company_id: str) -> str:
         """
@@ -22,7 +27,7 @@ class StorageService:
             self.supabase.storage.from_(BUCKET_NAME).upload(
                 path=path,
                 file=file_content,
-                file_options={"content-type": content_type, "upsert": "false"}
+                file_options={"content-type": content_type, "cache-control": CACHE_CONTROL_MAX_AGE, "upsert": "false"}
             )
             return path
         except Exception as e:
@@ -33,10 +38,23 @@ class StorageService:
             self.supabase.storage.from_(BUCKET_NAME).upload(
                 path=path,
                 file=file_content,
-                file_options={"content-type": content_type, "upsert": "true"}
+                file_options={"content-type": content_type, "cache-control": CACHE_CONTROL_MAX_AGE, "upsert": "true"}
             )
             return path
 
+    def upload_rendition(self, path: str, content: bytes, content_type: str) -> str:
+        """Upload a derived rendition (thumbnail/preview); re-rendering overwrites it."""
+        self.supabase.storage.from_(BUCKET_NAME).upload(
+            path=path,
+            file=content,
+            file_options={"content-type": content_type, "cache-control": CACHE_CONTROL_MAX_AGE, "upsert": "true"}
+        )
+        return path
+
+    def download_file(self, path: str) -> bytes:
+        """Download the raw bytes of a file in storage"""
+        return self.supabase.storage.from_(BUCKET_NAME).download(path)
+
     def get_public_url(self, path: str) -> str:
         """Get public URL for a file in storage"""
         return self.supabase.storage.from_(BUCKET_NAME).get_public_url(path)
@@ -0,0 +1,281 @@
+"""
+Layout-fingerprint templates learned from approved extractions.
+
+A template records, for one recurring document layout of a company:
+- the fingerprint (perceptual hash + text anchor positions) used to recognise it
+- where each approved field value was found on the page ("fields")
+- the column x-ranges, start, stop marker (e.g. "合计") and cell kinds
+  (date / number / text) of list fields such as invoice items or bank
+  transactions ("tables")
+
+Documents matching a template are extracted locally from positioned words;
+the parser only calls the LLM when the match or the extraction confidence is low.
+"""
+import os
+import re
+
+from services.layout import DocumentLayout, anchor_similarity, hash_similarity
+
+MATCH_THRESHOLD = float(os.environ.get("TEMPLATE_MATCH_THRESHOLD", "0.8"))
+MIN_CONFIDENCE = float(os.environ.get("TEMPLATE_MIN_CONFIDENCE", "0.85"))
+REGION_MARGIN = 0.01
+MAX_SPAN_WORDS = 8
+_DATE = re.compile(r"\d{4}\s*[-/.年]\s*\d{1,2}\s*[-/.月]\s*\d{1,2}|\d{8}(?!\d)")
+
+
+def _normalize(value) -> str:
+    text = re.sub(r"[\s,¥￥]", "", str(value)).lower()
+    try:
+        return f"{float(text):.2f}"
+    except ValueError:
+        return text
+
+
+def _kind(value) -> str:
+    """Cell kind used to validate table rows: "date", "number" or "text"."""
+    text = str(value).strip()
+    if _DATE.match(text):
+        return "date"
+    try:
+        float(re.sub(r"[\s,¥￥]", "", text))
+        return "number"
+    except ValueError:
+        return "text"
+
+
+def _center(word):
+    return (word["x0"] + word["x1"]) / 2, (word["y0"] + word["y1"]) / 2
+
+
+def _lines(words: list) -> list:
+    """
+    Group words into visual rows (reading order) by vertical centre.
+    Extractor line ids are not used: PyMuPDF and Tesseract split one table row
+    into several "lines" wherever there is a horizontal gap between cells.
+    """
+    rows = []
+    for w in sorted(words, key=lambda w: _center(w)[1]):
+        cy = _center(w)[1]
+        height = w["y1"] - w["y0"]
+        if rows:
+            row = rows[-1]
+            if abs(cy - row["cy"]) <= max(height, row["height"]) / 2:
+                row["words"].append(w)
+                row["cy"] += (cy - row["cy"]) / len(row["words"])
+                row["height"] = max(row["height"], height)
+                continue
+        rows.append({"words": [w], "cy": cy, "height": height})
+    return [sorted(row["words"], key=lambda w: w["x0"]) for row in rows]
+
+
+def _find_value(lines: list, value):
+    """Locate a value as a run of consecutive words on one line. Returns (box, joiner) or None."""
+    target = _normalize(value)
+    if not target:
+        return None
+    for line in lines:
+        for start in range(len(line)):
+            for end in range(start + 1, min(len(line), start + MAX_SPAN_WORDS) + 1):
+                span = line[start:end]
+                for joiner in ("", " "):
+                    if _normalize(joiner.join(w["text"] for w in span)) == target:
+                        return [
+                            min(w["x0"] for w in span),
+                            min(w["y0"] for w in span),
+                            max(w["x1"] for w in span),
+                            max(w["y1"] for w in span),
+                        ], joiner
+    return None
+
+
+def _union(a: list, b: list) -> list:
+    return [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+
+
+class TemplateService:
+    def __init__(self, repo):
+        self.repo = repo
+
+    def score(self, template: dict, layout: DocumentLayout) -> float:
+        """How well a layout matches a template fingerprint (0..1)."""
+        hash_score = hash_similarity(template.get("layout_hash"), layout.phash)
+        if template.get("anchors") and layout.words:
+            return 0.4 * hash_score + 0.6 * anchor_similarity(template["anchors"], layout.words)
+        return hash_score
+
+    def match(self, company_id: str, layout: DocumentLayout, doc_type: str = None, templates: list = None):
+        """
+        Best matching template above MATCH_THRESHOLD as (template, score), or (None, 0.0).
+        templates: candidates already fetched by the caller, to avoid a second query.
+        """
+        if templates is None:
+            templates = self.repo.find_templates(company_id, doc_type)
+        best, best_score = None, 0.0
+        for template in templates:
+            score = self.score(template, layout)
+            if score > best_score:
+                best, best_score = template, score
+        if best_score < MATCH_THRESHOLD:
+            return None, best_score
+        return best, best_score
+
+    def extract(self, template: dict, layout: DocumentLayout, match_score: float):
+        """Extract data from positioned words. Returns (data, confidence)."""
+        regions = template.get("field_regions") or {}
+        data = {}
+        ratios = []
+
+        fields = regions.get("fields", {})
+        if fields:
+            filled = 0
+            for name, region in fields.items():
+                value = self._read_region(layout.words, region["box"], region.get("joiner", ""))
+                data[name] = value
+                if value:
+                    filled += 1
+            ratios.append(filled / len(fields))
+
+        for name, table in regions.get("tables", {}).items():
+            rows, valid_ratio = self._read_table(layout, table)
+            data[name] = rows
+            ratios.append(valid_ratio)
+
+        if not ratios:
+            return data, 0.0
+        confidence = round(match_score * sum(ratios) / len(ratios), 4)
+        return data, confidence
+
+    def _read_region(self, words: list, box: list, joiner: str) -> str:
+        x0, y0, x1, y1 = box
+        inside = []
+        for w in words:
+            cx, cy = _center(w)
+            if x0 - REGION_MARGIN <= cx <= x1 + REGION_MARGIN and y0 - REGION_MARGIN <= cy <= y1 + REGION_MARGIN:
+                inside.append(w)
+        inside.sort(key=lambda w: (round(w["y0"], 2), w["x0"]))
+        return joiner.join(w["text"] for w in inside).strip()
+
+    def _read_table(self, layout: DocumentLayout, table: dict):
+        """
+        Rows of a list field: lines from the learned start down to the stop marker,
+        cut into the learned columns. Returns (rows, share of candidate rows whose
+        cells match the learned kinds).
+        """
+        columns = table["columns"]
+        joiners = table.get("joiners", {})
+        kinds = table.get("kinds", {})
+        stop = table.get("stop")
+        rows = []
+        candidates = 0
+        for index, page in enumerate(layout.pages):
+            start_y = table["y0"] - REGION_MARGIN if index == 0 else 0.0
+            for line in _lines([w for w in page.words if _center(w)[1] >= start_y]):
+                if stop and _normalize("".join(w["text"] for w in line)).startswith(stop):
+                    return rows, (len(rows) / candidates if candidates else 0.0)
+                row = {}
+                for key, (x0, x1) in columns.items():
+                    cells = [w["text"] for w in line if x0 - REGION_MARGIN <= _center(w)[0] <= x1 + REGION_MARGIN]
+                    row[key] = joiners.get(key, "").join(cells).strip()
+                # Headers/footers rarely fill most columns; keep rows that do
+                if sum(1 for v in row.values() if v) * 2 <= len(columns):
+                    continue
+                candidates += 1
+                if all(not v or kinds.get(k, "text") == "text" or _kind(v) == kinds[k] for k, v in row.items()):
+                    rows.append(row)
+        return rows, (len(rows) / candidates if candidates else 0.0)
+
+    def learn(self, company_id: str, doc_type: str, layout: DocumentLayout, data: dict):
+        """Learn or refine the template for this layout from approved values."""
+        lines = _lines(layout.words)
+        fields = {}
+        tables = {}
+        for name, value in (data or {}).items():
+            if isinstance(value, list):
+                table = self._learn_table(lines, value)
+                if table:
+                    tables[name] = table
+            elif value not in (None, ""):
+                found = _find_value(lines, value)
+                if found:
+                    fields[name] = {"box": found[0], "joiner": found[1]}
+
+        if not fields and not tables:
+            print(f"[Templates] No approved values located on the page, nothing to learn")
+            return None
+
+        existing, score = self.match(company_id, layout, doc_type)
+        if existing:
+            regions = existing.get("field_regions") or {}
+            merged_fields = regions.get("fields", {})
+            for name, region in fields.items():
+                if name in merged_fields:
+                    region = {**region, "box": _union(merged_fields[name]["box"], region["box"])}
+                merged_fields[name] = region
+            merged_tables = regions.get("tables", {})
+            for name, table in tables.items():
+                if name in merged_tables:
+                    old = merged_tables[name]
+                    for key, (x0, x1) in old["columns"].items():
+                        if key in table["columns"]:
+                            nx0, nx1 = table["columns"][key]
+                            table["columns"][key] = [min(x0, nx0), max(x1, nx1)]
+                        else:
+                            table["columns"][key] = [x0, x1]
+                    table["y0"] = min(old["y0"], table["y0"])
+                    for key, kind in old.get("kinds", {}).items():
+                        # Samples that disagree on a column's kind leave it unvalidated
+                        table["kinds"][key] = kind if table["kinds"].get(key, kind) == kind else "text"
+                    table["stop"] = old.get("stop") or table["stop"]
+                merged_tables[name] = table
+            template = self.repo.update_template(existing["id"], {
+                "field_regions": {"fields": merged_fields, "tables": merged_tables},
+                "sample_count": (existing.get("sample_count") or 1) + 1,
+            })
+            print(f"[Templates] Refined template {existing['id']} (match score {score:.2f})")
+            return template
+
+        template = self.repo.save_template({
+            "company_id": company_id,
+            "doc_type": doc_type,
+            "layout_hash": layout.phash,
+            "anchors": layout.anchors,
+            "field_regions": {"fields": fields, "tables": tables},
+            "sample_count": 1,
+        })
+        print(f"[Templates] Learned new {doc_type} template {template['id']}: {len(fields)} fields, {len(tables)} tables")
+        return template
+
+    def _learn_table(self, lines: list, items: list):
+        columns = {}
+        joiners = {}
+        kinds = {}
+        y0 = y1 = None
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            for key, value in item.items():
+                if value in (None, ""):
+                    continue
+                found = _find_value(lines, value)
+                if not found:
+                    continue
+                box, joiner = found
+                x0, x1 = columns.get(key, [box[0], box[2]])
+                columns[key] = [min(x0, box[0]), max(x1, box[2])]
+                joiners[key] = joiner
+                kind = _kind(value)
+                kinds[key] = kind if kinds.get(key, kind) == kind else "text"
+                y0 = box[1] if y0 is None else min(y0, box[1])
+                y1 = box[3] if y1 is None else max(y1, box[3])
+        if not columns:
+            return None
+        return {"y0": y0, "columns": columns, "joiners": joiners, "kinds": kinds, "stop": self._stop_marker(lines, y1)}
+
+    def _stop_marker(self, lines: list, y1: float):
+        """Label starting the first line below the last approved row (e.g. "合计"), if any."""
+        for line in lines:
+            if min(w["y0"] for w in line) <= y1:
+                continue
+            label = _normalize(line[0]["text"])
+            return label if label and not re.search(r"\d", label) else None
+        return None
@@ -0,0 +1,255 @@
+"""
+LLM usage accounting, per-company token budgets and adaptive concurrency.
+
+- UsageRecorder buffers one record per LLM call (tokens, latency, cost) and
+  writes them to llm_usage in batches from a background thread
+- budgets (company_llm_budgets.monthly_token_limit) are checked before each call
+- AdaptiveLimiter caps concurrent LLM calls with AIMD: +1/limit per healthy call,
+  halve on 429s or latency above target, so throughput follows the provider's
+  real capacity
+"""
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from repository import get_repository, is_connection_error
+
+FLUSH_INTERVAL = float(os.environ.get("LLM_USAGE_FLUSH_SECONDS", "5"))
+FLUSH_BATCH_SIZE = int(os.environ.get("LLM_USAGE_BATCH_SIZE", "50"))
+BUDGET_CACHE_SECONDS = 60
+MAX_BUFFERED = 10000  # drop the oldest records if the DB stays unreachable
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+class UsageRecorder:
+    def __init__(self, repo):
+        self.repo = repo
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        # company_id -> {"limit", "used", "loaded_at"}; "used" includes tokens recorded since loading
+        self._budgets = {}
+
+    def record(self, context: dict, provider: str, model: str, call_type: str, usage, latency: float, status: str):
+        """
+        Account one call. Attribution (company_id, document_id, doc_type) is copied from
+        context now. If context has a "held" list the record is appended there instead of
+        being queued; the caller passes it to release() once the doc_type is known.
+        """
+        context = context if context is not None else {}
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+        completion_tokens = getattr(usage, "completion_tokens", None) or 0
+        total_tokens = getattr(usage, "total_tokens", None) or prompt_tokens + completion_tokens
+        entry = {
+            "company_id": context.get("company_id"),
+            "document_id": context.get("document_id"),
+            "doc_type": context.get("doc_type"),
+            "provider": provider,
+            "model": model,
+            "call_type": call_type,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+            "cost": getattr(usage, "cost", None),  # reported by OpenRouter
+            "latency_ms": int(latency * 1000),
+            "status": status,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        with self._lock:
+            # Budgets count the tokens right away, even while the record is held
+            budget = self._budgets.get(entry["company_id"])
+            if budget:
+                budget["used"] += total_tokens
+        held = context.get("held")
+        if held is not None:
+            held.append(entry)
+            return
+        self._enqueue([entry])
+
+    def release(self, entries: list, doc_type: str = None):
+        """
+        Queue records held back by record(), filling in the doc_type now that it is known.
+        Empties entries, so releasing the same list again is a no-op.
+        """
+        released, entries[:] = list(entries), []
+        if not released:
+            return
+        for entry in released:
+            entry["doc_type"] = entry["doc_type"] or doc_type
+        self._enqueue(released)
+
+    def _enqueue(self, entries: list):
+        with self._lock:
+            self._buffer.extend(entries)
+            full = len(self._buffer) >= FLUSH_BATCH_SIZE
+            self._ensure_thread()
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._lock:
+            entries, self._buffer = self._buffer, []
+        if not entries:
+            return
+        try:
+            self.repo.insert_llm_usage(entries)
+            print(f"[Usage] Flushed {len(entries)} usage record(s)")
+        except Exception as e:
+            if is_connection_error(e):
+                self._requeue(entries, e)
+                return
+            # A rejected row (e.g. its document was deleted meanwhile) must not block the rest
+            print(f"[Usage] Batch insert rejected, inserting {len(entries)} record(s) one by one: {e}")
+            self._insert_each(entries)
+
+    def _insert_each(self, entries: list):
+        for index, entry in enumerate(entries):
+            # Retry without the document link: the tokens still count towards the company
+            attempts = [entry, {**entry, "document_id": None}] if entry.get("document_id") else [entry]
+            error = None
+            for row in attempts:
+                try:
+                    self.repo.insert_llm_usage([row])
+                    error = None
+                    break
+                except Exception as e:
+                    if is_connection_error(e):
+                        self._requeue(entries[index:], e)
+                        return
+                    error = e
+            if error is not None:
+                print(f"[Usage] Dropped usage record rejected by the database: {error}")
+
+    def _requeue(self, entries: list, error: Exception):
+        print(f"[Usage] Flush failed, {len(entries)} record(s) re-queued: {error}")
+        with self._lock:
+            self._buffer = (entries + self._buffer)[-MAX_BUFFERED:]
+
+    def check_budget(self, company_id: str):
+        """Raise BudgetExceededError if the company used up its monthly token budget."""
+        if not company_id:
+            return
+        with self._lock:
+            budget = self._budgets.get(company_id)
+        if budget is None or time.monotonic() - budget["loaded_at"] > BUDGET_CACHE_SECONDS:
+            budget = self._load_budget(company_id)
+        if budget["limit"] is not None and budget["used"] >= budget["limit"]:
+            raise BudgetExceededError(
+                f"Monthly LLM token budget exhausted for company {company_id} "
+                f"({budget['used']}/{budget['limit']} tokens)"
+            )
+
+    def _load_budget(self, company_id: str) -> dict:
+        # Flush first so the month total from the DB includes everything recorded so far
+        self.flush()
+        budget = {
+            "limit": self.repo.get_company_token_budget(company_id),
+            "used": self.repo.get_company_month_tokens(company_id),
+            "loaded_at": time.monotonic(),
+        }
+        with self._lock:
+            self._budgets[company_id] = budget
+        return budget
+
+    def invalidate_budget(self, company_id: str):
+        with self._lock:
+            self._budgets.pop(company_id, None)
+
+    def _ensure_thread(self):
+        # Called with self._lock held
+        if self._thread is None and not self._stopped:
+            self._thread = threading.Thread(target=self._run, name="llm-usage-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(FLUSH_INTERVAL)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=FLUSH_INTERVAL)
+        self.flush()
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for LLM calls."""
+
+    def __init__(self, initial: int, minimum: int, maximum: int, latency_target: float):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency: float, throttled: bool = False):
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled or latency > self.latency_target:
+                # Decrease at most once per latency window, so one burst of slow calls counts once
+                if now - self._last_decrease > self.latency_target:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+                    print(f"[LLM] Concurrency limit decreased to {int(self.limit)} "
+                          f"({'429' if throttled else f'latency {latency:.1f}s'})")
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {"limit": int(self.limit), "in_flight": self.in_flight}
+
+
+_recorder = None
+_limiter = None
+_singleton_lock = threading.Lock()
+
+
+def get_usage_recorder() -> UsageRecorder:
+    global _recorder
+    if _recorder is None:
+        with _singleton_lock:
+            if _recorder is None:
+                _recorder = UsageRecorder(get_repository())
+    return _recorder
+
+
+def close_usage_recorder():
+    global _recorder
+    with _singleton_lock:
+        recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.close()
+
+
+def get_llm_limiter() -> AdaptiveLimiter:
+    global _limiter
+    if _limiter is None:
+        with _singleton_lock:
+            if _limiter is None:
+                _limiter = AdaptiveLimiter(
+                    initial=int(os.environ.get("LLM_CONCURRENCY_INITIAL", "4")),
+                    minimum=int(os.environ.get("LLM_CONCURRENCY_MIN", "1")),
+                    maximum=int(os.environ.get("LLM_CONCURRENCY_MAX", "32")),
+                    latency_target=float(os.environ.get("LLM_LATENCY_TARGET_SECONDS", "30")),
+                )
+    return _limiter
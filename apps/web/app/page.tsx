@@ -359,6 +359,14 @@ export default function DashboardPage() {
             <div className="space-y-2">
               {documents.map((doc) => (
                 <div key={doc.id} className="flex items-center justify-between p-3 border rounded-lg hover:bg-slate-50">
+                  {doc.thumbnail_path && (
+                    <img
+                      src={getFileUrl(doc.thumbnail_path)}
+                      alt={doc.name}
+                      loading="lazy"
+                      className="h-12 w-12 object-cover border rounded mr-3"
+                    />
+                  )}
                   <div className="flex-1">
                     <p className="font-medium">{doc.name}</p>
                     <div className="flex gap-4 text-xs text-muted-foreground mt-1">
@@ -422,7 +430,20 @@ export default function DashboardPage() {
                 {selectedDoc.storage_path && (
                   <div>
                     <p className="text-sm font-medium mb-2">文件预览:</p>
-                    {selectedDoc.file_type?.startsWith('image/') ? (
+                    {selectedDoc.preview_path ? (
+                      <a
+                        href={getFileUrl(selectedDoc.storage_path)}
+                        target="_blank"
+                        rel="noopener noreferrer"
+                        title="点击查看原始文件"
+                      >
+                        <img
+                          src={getFileUrl(selectedDoc.preview_path)}
+                          alt={selectedDoc.name}
+                          className="max-w-full h-auto border rounded"
+                        />
+                      </a>
+                    ) : selectedDoc.file_type?.startsWith('image/') ? (
                       <img 
                         src={getFileUrl(selectedDoc.storage_path)} 
                         alt={selectedDoc.name}
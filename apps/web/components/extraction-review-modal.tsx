@@ -282,7 +282,18 @@ export function ExtractionReviewModal({ documentId, open, onClose, onApproved }:
                       const isPdf = fileName.endsWith('.pdf') || fileType.includes('pdf')
                       const isImage = fileName.match(/\.(jpg|jpeg|png|gif|webp)$/i) || fileType.startsWith('image/')
                       
-                      if (isImage) {
+                      // Web-optimized rendition generated at upload; the original opens in a new tab
+                      if (document.preview_path) {
+                        return (
+                          <img 
+                            src={getFileUrl(document.preview_path)} 
+                            alt={document.name}
+                            className="w-full h-auto cursor-pointer"
+                            onClick={openInNewTab}
+                            title="点击在新窗口打开原始文件"
+                          />
+                        )
+                      } else if (isImage) {
                         return (
                           <img 
                             src={fileUrl} 
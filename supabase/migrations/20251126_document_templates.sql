@@ -0,0 +1,23 @@
+-- Layout-fingerprint templates learned from approved extractions
+-- Matching documents are extracted locally instead of calling the LLM
+
+CREATE TABLE IF NOT EXISTS document_templates (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4 (),
+    company_id UUID REFERENCES companies (id) ON DELETE CASCADE,
+    doc_type VARCHAR(50) NOT NULL,
+    layout_hash VARCHAR(16), -- perceptual hash of the first page (hex)
+    anchors JSONB DEFAULT '[]'::jsonb, -- [{text, x, y}] label positions, normalized 0..1
+    field_regions JSONB DEFAULT '{}'::jsonb, -- {fields: {name: {box, joiner}}, tables: {name: {y0, columns, joiners}}}
+    sample_count INTEGER DEFAULT 1,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_document_templates_company ON document_templates (company_id, doc_type);
+
+-- How each extraction was produced: llm, template
+ALTER TABLE extraction_results
+ADD COLUMN IF NOT EXISTS extraction_method VARCHAR(20) DEFAULT 'llm';
+
+ALTER TABLE extraction_results
+ADD COLUMN IF NOT EXISTS template_id UUID REFERENCES document_templates (id) ON DELETE SET NULL;
@@ -0,0 +1,41 @@
+-- LLM usage accounting and per-company token budgets
+
+CREATE TABLE IF NOT EXISTS llm_usage (
+    id UUID PRIMARY KEY DEFAULT uuid_generate_v4 (),
+    company_id UUID REFERENCES companies (id) ON DELETE CASCADE,
+    document_id UUID REFERENCES documents (id) ON DELETE SET NULL,
+    doc_type VARCHAR(50),
+    provider VARCHAR(50),
+    model VARCHAR(100),
+    call_type VARCHAR(20), -- text, image
+    prompt_tokens INTEGER DEFAULT 0,
+    completion_tokens INTEGER DEFAULT 0,
+    total_tokens INTEGER DEFAULT 0,
+    cost DECIMAL(12, 6), -- provider-reported cost (USD), if available
+    latency_ms INTEGER,
+    status VARCHAR(20) DEFAULT 'ok', -- ok, error
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_llm_usage_company_created ON llm_usage (company_id, created_at);
+
+CREATE INDEX IF NOT EXISTS idx_llm_usage_provider_model ON llm_usage (provider, model);
+
+-- Monthly token budget per company (no row = unlimited)
+CREATE TABLE IF NOT EXISTS company_llm_budgets (
+    company_id UUID PRIMARY KEY REFERENCES companies (id) ON DELETE CASCADE,
+    monthly_token_limit BIGINT,
+    created_at TIMESTAMPTZ DEFAULT NOW(),
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+-- Month-to-date totals, used for budget checks
+CREATE OR REPLACE VIEW llm_usage_monthly AS
+SELECT
+    company_id,
+    date_trunc('month', created_at) AS month,
+    SUM(total_tokens) AS total_tokens,
+    SUM(cost) AS cost,
+    COUNT(*) AS calls
+FROM llm_usage
+GROUP BY company_id, date_trunc('month', created_at);
@@ -0,0 +1,6 @@
+-- Thumbnail / preview renditions generated at upload time (paths in the raw-files bucket)
+ALTER TABLE documents
+ADD COLUMN IF NOT EXISTS thumbnail_path VARCHAR(255);
+
+ALTER TABLE documents
+ADD COLUMN IF NOT EXISTS preview_path VARCHAR(255);